@@ -2,17 +2,28 @@
 
 import os
 import argparse
+import ctypes
+import collections
+import concurrent.futures
+import copy
 import subprocess
 import shutil
 import tempfile
 import fnmatch
+import hashlib
+import io
 import json
-import tokenize
+import re
 import zipfile
+import zlib
 import time
 import sys
 import struct
-import platform
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 
 class TargetType:
@@ -22,8 +33,25 @@ class TargetType:
     IONIC = 4,
     DEFAULT = 5
 
+
+ANDROID_TARGET_TYPE_NAMES = {
+    TargetType.REACT_NATIVE: 'reactnative-android',
+    TargetType.NATIVESCRIPT: 'nativescript-android',
+    TargetType.CORDOVA: 'cordova-android',
+    TargetType.IONIC: 'ionic-android'
+}
+
 # # # ARGUMENTS # # #
 
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("'{}' is not a positive integer".format(value))
+    return number
+
 
 def parse_cli_args():
     parser = argparse.ArgumentParser(
@@ -33,6 +61,9 @@ def parse_cli_args():
                         required=True)
     parser.add_argument("-b4h", "--blueprint-for-hybrid", metavar="<PATH>",
                         help="Path to the blueprint file for protect-hybrid-js.")
+    parser.add_argument("-b4ho", "--blueprint-overlay-for-hybrid", metavar="<PATH>", action='append',
+                        help="Path to a blueprint overlay deep-merged over the blueprint for protect-hybrid-js. "
+                             "Can be repeated, later overlays take precedence.")
     parser.add_argument("-b4a", "--blueprint-for-android", metavar="<PATH>",
                         help="Path to the blueprint file for protect-android.")
     target_type_group = parser.add_mutually_exclusive_group(required=False)
@@ -62,10 +93,45 @@ def parse_cli_args():
     parser.add_argument("-dnp", "--disable-native-protection",
                         help="Flag to disable protection using Digital.ai Android App Protection.",
                         action='store_true')
+    parser.add_argument("-j", "--jobs", metavar="<COUNT>", type=positive_int,
+                        help="Number of worker threads used to extract and compress the APK/AAB (default: number of CPUs).")
+    parser.add_argument("-rb", "--repack-buffer-size", metavar="<MB>", type=positive_int,
+                        help="Buffer size in MB for each entry being repacked; larger compressed entries "
+                             "are buffered on disk (default: 1).")
+    parser.add_argument("-pg", "--page-alignment", metavar="<KB>", type=int, choices=[4, 16], default=ZIP_PAGE_ALIGNMENT_KB,
+                        help="Page size in KB uncompressed native libraries of the repacked APK are aligned to: "
+                             "4 or 16 (default: 16).")
+    parser.add_argument("-sx", "--selective-extraction",
+                        help="Flag to extract only AndroidManifest.xml and protectable JavaScript files. "
+                             "Other entries are repacked from the input APK/AAB.",
+                        action='store_true')
+    parser.add_argument("-cp", "--compression-policy", metavar="<PATH>",
+                        help="Path to the compression policy file, rules choosing the compression of repacked files.")
+    parser.add_argument("-ws", "--workspace", metavar="<PATH>",
+                        help="Folder for the temporary files, 'ram' for a RAM-backed folder (/dev/shm). "
+                             "The default temporary folder is used if the APK/AAB does not fit (default: temporary folder).")
+    parser.add_argument("-ac", "--async-cleanup",
+                        help="Flag to remove temporary files in a background process after the script finishes.",
+                        action='store_true')
+    parser.add_argument("-rf", "--renamed-files", metavar="<PATH>",
+                        help="Path to the JSON file listing the entries extracted under new names because of "
+                             "case insensitive name collisions (default: not written).")
 
     return parser.parse_args()
 
 
+def get_target_type(args):
+    if args.reactnative:
+        return TargetType.REACT_NATIVE
+    if args.nativescript:
+        return TargetType.NATIVESCRIPT
+    if args.cordova:
+        return TargetType.CORDOVA
+    if args.ionic:
+        return TargetType.IONIC
+    return TargetType.DEFAULT
+
+
 # # # HybridJavaScriptProtection # # #
 
 class HybridJavaScriptProtection:
@@ -77,6 +143,7 @@ class HybridJavaScriptProtection:
         self.updated_config_file_path = None
         self.input_folder = None
         self.output_folder = None
+        self.work_folder = None
         self.target_type = TargetType.DEFAULT
 
     def protect(self):
@@ -88,29 +155,37 @@ class HybridJavaScriptProtection:
 
     def update_relative_ignorepaths(self):
         if self.input_folder and self.config_file_path:
-            protect_hybrid_json = load_json_from_file(self.config_file_path)
+            # shallow copies down to each target, the loaded blueprint is shared
+            protect_hybrid_json = load_json_from_file(self.config_file_path).copy()
 
             targets = get_insensitive(protect_hybrid_json, "targets")
             paths_updated = False
             if targets:
+                targets = targets.copy()
+                set_insensitive(protect_hybrid_json, "targets", targets)
+                target_paths = {}
                 for target in targets:
                     old_paths = get_insensitive(targets[target], 'ignorePaths')
                     if old_paths:
-                        updated_paths = []
-                        for path in old_paths:
-                            if os.path.exists(path):
-                                updated_path = path
-                            else:
-                                realpath = os.path.realpath(self.input_folder)
-                                updated_path = os.path.join(realpath, path.strip("/"))
-                            updated_paths.append(updated_path)
-                        set_insensitive(targets[target], 'ignorePaths',  updated_paths)
-                        paths_updated = True
+                        target_paths[target] = old_paths
+                # all targets are resolved in one batch, shared paths are checked once
+                resolved_paths = resolve_ignore_paths(
+                    [path for old_paths in target_paths.values() for path in old_paths], self.input_folder)
+                for target, old_paths in target_paths.items():
+                    targets[target] = targets[target].copy()
+                    set_insensitive(targets[target], 'ignorePaths', [resolved_paths[path] for path in old_paths])
+                    paths_updated = True
             if paths_updated:
-                self.updated_config_file_path = self.config_file_path + ".updated"
+                self.updated_config_file_path = self.get_updated_config_file_path()
                 with open(self.updated_config_file_path, 'w') as output_json_file:
                     json.dump(protect_hybrid_json, output_json_file, indent=2)
 
+    def get_updated_config_file_path(self):
+        # inside the job's own folder, concurrent runs sharing a blueprint do not overwrite each other
+        if self.work_folder:
+            return os.path.join(self.work_folder, os.path.basename(self.config_file_path) + ".updated")
+        return self.config_file_path + ".updated"
+
     def create_protect_hybrid_arguments(self):
         protect_hybrid_args = []
         if self.config_file_path:
@@ -144,109 +219,544 @@ class HybridJavaScriptProtection:
         return protect_hybrid_args
 
 
-# # # Json load with comments removal # # #
-SKIP_TOKEN_TYPES = [tokenize.ENCODING, tokenize.NL, tokenize.NEWLINE, tokenize.ENDMARKER]
-
-def get_ignored_tokens_count(tokens, current_idx):
-    max_idx = len(tokens)
-    if current_idx >= max_idx:
-        return 0
-    token = tokens[current_idx]
-
-    if token.type == tokenize.OP:
-        # single line comment skip
-        if token.string == '//':
-            for idx in range(current_idx + 1, max_idx):
-                token = tokens[idx]
-                if token.type == tokenize.NL or token.type == tokenize.NEWLINE:
-                    return idx - current_idx
-            return 0
-
-        # multiline comment skip
-        if token.string == '/' and (current_idx < max_idx - 1) and tokens[current_idx + 1].string == '*':
-            for idx in range(current_idx + 1, max_idx - 1):
-                token = tokens[idx]
-                if token.string == '*' and tokens[idx + 1].string == '/':
-                    return 2 + idx - current_idx
-            return 0
-    elif token.type in SKIP_TOKEN_TYPES:
-        return 1
-    return 0
-
-def is_trailing_comma(tokens, current_idx):
-    token = tokens[current_idx]
-    max_idx = len(tokens)
-    return (token.type == tokenize.OP and
-            token.string == ',' and
-            ( current_idx + 1 == max_idx or tokens[current_idx + 1].string == "}" or tokens[current_idx + 1].string == "]"))
-
-def remove_comments_and_newlines(tokens):
-    output = []
-    max_idx = len(tokens)
-    idx = 0
-    while idx < max_idx:
-        count = get_ignored_tokens_count(tokens, idx)
-        if (count):
-            idx += count
-        else:
-            output.append(tokens[idx])
-            idx += 1
-    return output
+# # # Blueprint cache # # #
+# Opt-in: set PROTECT_HYBRID_BLUEPRINT_CACHE to a directory (or to "1" for ~/.cache/protect-hybrid-js/blueprints)
+# to keep comment-free blueprints keyed by the SHA-256 of the raw file, so unchanged blueprints skip normalization.
+BLUEPRINT_LOADER_VERSION = "2"
+BLUEPRINT_CACHE_DEFAULT_SIZE_MB = 64
+
+def get_blueprint_cache_folder():
+    folder = os.environ.get('PROTECT_HYBRID_BLUEPRINT_CACHE')
+    if not folder:
+        return None
+    if folder == "1":
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        folder = os.path.join(cache_home, 'protect-hybrid-js', 'blueprints')
+    return folder
 
-def remove_trailing_commas(tokens):
-    output = []
-    for i in range(0, len(tokens)):
-        if (not is_trailing_comma(tokens, i)):
-            output.append(tokens[i])
-    return output
+def get_blueprint_cache_key(buffer):
+    return hashlib.sha256(buffer).hexdigest() + '-v' + BLUEPRINT_LOADER_VERSION + '.json'
+
+def read_blueprint_cache(folder, key):
+    cache_file = os.path.join(folder, key)
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as json_file:
+            json_str = json_file.read()
+        os.utime(cache_file)  # least recently used entries are evicted first
+        return json_str
+    except OSError:
+        return None
+
+def write_blueprint_cache(folder, key, json_str):
+    temporary_file = None
+    try:
+        os.makedirs(folder, exist_ok=True)
+        # write next to the final entry and rename, concurrent runs never see a partial file
+        fd, temporary_file = tempfile.mkstemp(prefix='.' + key, dir=folder)
+        with os.fdopen(fd, 'w', encoding='utf-8') as json_file:
+            json_file.write(json_str)
+        os.replace(temporary_file, os.path.join(folder, key))
+        temporary_file = None
+        evict_blueprint_cache(folder)
+    except OSError:
+        if temporary_file is not None and os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+def evict_blueprint_cache(folder):
+    try:
+        max_size = int(os.environ.get('PROTECT_HYBRID_BLUEPRINT_CACHE_SIZE_MB', BLUEPRINT_CACHE_DEFAULT_SIZE_MB)) * 1024 * 1024
+    except ValueError:
+        max_size = BLUEPRINT_CACHE_DEFAULT_SIZE_MB * 1024 * 1024
+    entries = []
+    total_size = 0
+    for name in os.listdir(folder):
+        if name.startswith('.'):  # write in progress
+            continue
+        path = os.path.join(folder, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total_size += stat.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size -= size
+
+# # # Json load with comments removal # # #
+# Single pass over the raw bytes: findall() returns only the kept group, so whitespace, comments and trailing commas
+# (followed only by whitespace/comments and '}', ']' or end of file) are dropped. Comments are recognized as the
+# previous tokenize based loader did: '//' and '/*' not followed by '*' or '=', closed by an odd run of '*' and a '/'
+# not followed by '/' or '=' ('**' and '//' were operators, spaces between '/' and '*' were ignored), skipping quoted
+# strings and '#' comments in between. Strings (but triple quoted ones) end on their line, a lone quote is kept as is.
+JSONC_STRING = rb'"[^"\\\r\n]*(?:\\.[^"\\\r\n]*)*"'
+JSONC_TRIPLE_QUOTED = rb'"""(?:[^"\\]|\\[\s\S]|"(?!""))*"""|' + rb"""'''(?:[^'\\]|\\[\s\S]|'(?!''))*'''"""
+JSONC_LONE_QUOTE = rb"""(?:"(?![^"\\\r\n]*(?:\\.[^"\\\r\n]*)*")|'(?![^'\\\r\n]*(?:\\.[^'\\\r\n]*)*'))"""
+JSONC_QUOTED = (JSONC_TRIPLE_QUOTED + rb'|' + JSONC_STRING +
+                rb"""|'[^'\\\r\n]*(?:\\.[^'\\\r\n]*)*'|#[^\r\n]*(?![^\r\n])|""" + JSONC_LONE_QUOTE)
+JSONC_TOKEN = JSONC_QUOTED + rb"""|[^"'#*]"""
+JSONC_NO_TOKEN = rb'(?:' + JSONC_LONE_QUOTE + rb'|[\\$?`]|!(?!=))'
+JSONC_LINE_COMMENT = rb'//(?!=)[^\r\n]*(?![^\r\n])'
+JSONC_BLOCK_COMMENT = (rb'/(?=[ \t\f]*\*(?![*=]))(?:' + JSONC_TOKEN +  # never past its end
+                       rb'|(?:\*\*)+(?!\*)|\*(?:\*\*)*(?![*=]|[ \t\f]*/(?![/=])))*'
+                       rb'(?:\*\*)*\*[ \t\f]*/(?![/=])')
+
+# Single quoted strings, '#' comments and triple quoted strings were kept with their spaces, as were the spaces before
+# a lone quote or a character starting no token. An indented first line made the tokenize based loader end with
+# a DEDENT token, so the last comma was kept.
+def get_jsonc_strip_pattern(tokenize_quirks, indented):
+    if tokenize_quirks:
+        kept = JSONC_QUOTED + rb"""|[^\s"'#/,]+|[ \t\f]+(?=""" + JSONC_NO_TOKEN + rb')'
+        dropped = rb'\s+(?!\s|' + JSONC_NO_TOKEN + rb')|\s*[\r\n\v]'
+    else:
+        kept = JSONC_STRING + rb'|[^\s"/,]+|"'
+        dropped = rb'\s+'
+    end_of_file = rb'' if indented else rb'|\Z'
+    comment = JSONC_LINE_COMMENT + rb'|' + JSONC_BLOCK_COMMENT
+    return re.compile(
+        dropped + rb'|' + comment +  # whitespace and comments
+        rb'|((?:' + kept +  # kept: strings and plain JSON...
+        rb'|,(?!\s*(?:(?:' + comment + rb')\s*)*(?:[}\]]' + end_of_file + rb')))+'  # ...non-trailing commas
+        rb'|/)'  # ...and slashes starting no comment
+        rb'|,')  # trailing comma
+
+JSONC_STRIP_PATTERNS = {(tokenize_quirks, indented): get_jsonc_strip_pattern(tokenize_quirks, indented)
+                        for tokenize_quirks in (False, True) for indented in (False, True)}
+JSONC_SINGLE_QUOTED = JSONC_STRING + rb"""|'[^'\\\r\n]*(?:\\.[^'\\\r\n]*)*'|#[^\r\n]*"""
+JSONC_QUOTED_PATTERN = re.compile(JSONC_TRIPLE_QUOTED + rb'|' + JSONC_SINGLE_QUOTED)
+JSONC_UNTERMINATED_PATTERN = re.compile(
+    JSONC_TRIPLE_QUOTED + rb'''|("""|\'\'\'|"[^"\\\r\n]*(?:\\[^\r\n][^"\\\r\n]*)*\\\r?\n'''
+    rb"""|'[^'\\\r\n]*(?:\\[^\r\n][^'\\\r\n]*)*\\\r?\n)|""" + JSONC_SINGLE_QUOTED)
+JSONC_NO_TOKEN_PATTERN = re.compile(rb"""["'\\$?`!]""")
+# The tokenize based loader read the whole file as a single line: a blank first line made all of it blank and a '#'
+# at its start made all of it a comment.
+JSONC_LEADING_PATTERN = re.compile(rb'(?:\xef\xbb\xbf)?([ \t\f]*)([\r\n#]?)')
+
+def get_bracket_depth(data):
+    return (data.count(b'{') + data.count(b'[') + data.count(b'(') -
+            data.count(b'}') - data.count(b']') - data.count(b')'))
+
+# The tokenize based loader failed before the JSON was parsed on a triple quoted string left open or a string
+# continued by a backslash ending its line and, outside strings (code), comments included, on brackets left open
+# (or closed once too often) and on a backslash ending a line.
+def get_tokenize_error(buffer, code):
+    if b'"""' in buffer or b"'''" in buffer or b'\\\n' in buffer or b'\\\r\n' in buffer:
+        for match in JSONC_UNTERMINATED_PATTERN.finditer(buffer):
+            if match.group(1) is not None:
+                column = len(buffer[:match.start(1)].decode('utf-8-sig', 'replace'))
+                return "('EOF in multi-line string', (1, " + str(column) + "))"
+    if get_bracket_depth(code) != 0 or b'\\\n' in code or b'\\\r\n' in code:
+        return "('EOF in multi-line statement', (2, 0))"
+    return None
 
 def get_json_as_string(file_name):
-    output_string = ""
     with open(file_name, 'rb') as json_file:
-        try:
-            tokens = list(tokenize.tokenize(json_file.read))
-        except Exception as e:
-            raise ValueError("Provided blueprint file '" + file_name + "' contains invalid JSON. " + str(e))
-        tokens = remove_comments_and_newlines(tokens)
-        tokens = remove_trailing_commas(tokens)
-        for i in range(0, len(tokens)):
-            output_string += tokens[i].string
-    return output_string.strip()
+        buffer = json_file.read()
+    cache_folder = get_blueprint_cache_folder()
+    if cache_folder is not None:
+        cache_key = get_blueprint_cache_key(buffer)
+        json_str = read_blueprint_cache(cache_folder, cache_key)
+        if json_str is not None:
+            return json_str
+    leading = JSONC_LEADING_PATTERN.match(buffer)
+    if leading.group(2) == b'#':
+        json_bytes = buffer[leading.start(2):]
+    elif leading.group(2):
+        json_bytes = b''
+    else:
+        code = JSONC_QUOTED_PATTERN.sub(b' ', buffer)
+        tokenize_error = get_tokenize_error(buffer, code)
+        if tokenize_error is not None:
+            raise ValueError("Provided blueprint file '" + file_name + "' contains invalid JSON. " + tokenize_error)
+        tokenize_quirks = (JSONC_NO_TOKEN_PATTERN.search(code) is not None or
+                           b"'" in buffer or b'#' in buffer or b'"""' in buffer)
+        indented = leading.group(1).endswith((b' ', b'\t')) and leading.end() < len(buffer)
+        json_bytes = b''.join(JSONC_STRIP_PATTERNS[tokenize_quirks, indented].findall(buffer))
+    try:
+        json_str = json_bytes.decode('utf-8-sig').strip()
+    except Exception as e:
+        raise ValueError("Provided blueprint file '" + file_name + "' contains invalid JSON. " + str(e))
+    if cache_folder is not None:
+        write_blueprint_cache(cache_folder, cache_key, json_str)
+    return json_str
+
+class InsensitiveDict(dict):
+    """Blueprint object with its keys also indexed by lower case, so case insensitive lookups do not scan all keys.
+    Keys keep their original spelling, which is what json.dump writes back."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # reversed, so the first spelling of a key wins as with a linear scan
+        self.lower_keys = {key.lower(): key for key in reversed(list(self.keys()))}
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.lower_keys.setdefault(key.lower(), key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.forget_key(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __or__(self, other):
+        merged = self.copy()
+        merged.update(other)
+        return merged
+
+    def __ror__(self, other):
+        merged = InsensitiveDict(other)
+        merged.update(self)
+        return merged
+
+    # dict implements these without __setitem__ and __delitem__, the index is kept up to date here
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = super().pop(key)
+        self.forget_key(key)
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.forget_key(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self.lower_keys.clear()
+
+    def copy(self):
+        return InsensitiveDict(self)
+
+    @classmethod
+    def fromkeys(cls, keys, value=None):
+        return cls((key, value) for key in keys)
+
+    # removed key: another spelling of it takes over the index entry
+    def forget_key(self, key):
+        lower_key = key.lower()
+        if self.lower_keys.get(lower_key) == key:
+            del self.lower_keys[lower_key]
+            for other_key in self.keys():
+                if other_key.lower() == lower_key:
+                    self.lower_keys[lower_key] = other_key
+                    break
+
+    def find_key(self, key):
+        return self.lower_keys.get(key.lower())
+
+def find_insensitive_key(json, key):
+    if isinstance(json, InsensitiveDict):
+        return json.find_key(key)
+    lower_key = key.lower()
+    for existing_key in json.keys():
+        if existing_key.lower() == lower_key:
+            return existing_key
+    return None
 
 def get_insensitive(json, key):
     if (json is None):
         return None
-    keys = list(json.keys())
-    for i in range(0, len(keys)):
-        if (keys[i].lower() == key.lower()):
-            return json[keys[i]]
-    return None
+    existing_key = find_insensitive_key(json, key)
+    if existing_key is None:
+        return None
+    return json[existing_key]
 
 def set_insensitive(json, key, value):
     if (json is None):
         return None
-    keys = list(json.keys())
-    for i in range(0, len(keys)):
-        if (keys[i].lower() == key.lower()):
-            json[keys[i]] = value;
-            return;
+    existing_key = find_insensitive_key(json, key)
+    if existing_key is not None:
+        json[existing_key] = value
 
-def load_json_from_file(file_name):
+def parse_json_from_file(file_name):
     json_str = get_json_as_string(file_name)
     if len(json_str) == 0:
         raise ValueError("Provided blueprint file '" + file_name +
                          "' is empty. Make sure the file is a non-empty JSON.")
     try:
-        return json.loads(json_str)
+        return json.loads(json_str, object_pairs_hook=InsensitiveDict)
     except Exception as e:
         raise ValueError("Provided blueprint file '" + file_name + "' contains invalid JSON. " + str(e))
 
+# real path -> (mtime, size, parsed blueprint)
+LOADED_BLUEPRINTS = {}
+
+# Each blueprint is parsed once per process and the same document is returned to every caller,
+# so callers must not modify it (copy the parts to be changed instead).
+def load_json_from_file(file_name):
+    path = os.path.realpath(file_name)
+    stat = os.stat(path)
+    loaded = LOADED_BLUEPRINTS.get(path)
+    if loaded is not None and loaded[0] == stat.st_mtime_ns and loaded[1] == stat.st_size:
+        return loaded[2]
+    document = parse_json_from_file(file_name)
+    LOADED_BLUEPRINTS[path] = (stat.st_mtime_ns, stat.st_size, document)
+    return document
+
+# # # Blueprint overlays # # #
+# The base blueprint is deep-merged with ordered overlays (-b4ho), later overlays win. Objects are merged with case
+# insensitive keys keeping the base spelling, any other value (arrays included) is replaced and null removes the key.
+
+def merge_blueprint(base, overlay):
+    merged = base.copy()
+    for key, value in overlay.items():
+        existing_key = find_insensitive_key(merged, key)
+        if existing_key is None:
+            if value is not None:
+                merged[key] = value
+        elif value is None:
+            del merged[existing_key]
+        elif isinstance(merged[existing_key], dict) and isinstance(value, dict):
+            merged[existing_key] = merge_blueprint(merged[existing_key], value)
+        else:
+            merged[existing_key] = value
+    return merged
+
+def get_blueprint_overlay_key(file_names):
+    digest = hashlib.sha256()
+    for file_name in file_names:
+        with open(file_name, 'rb') as blueprint_file:
+            digest.update(hashlib.sha256(blueprint_file.read()).digest())
+    return digest.hexdigest() + '-v' + BLUEPRINT_LOADER_VERSION + '.merged.json'
+
+# overlay key -> merged blueprint, as written to the temporary file
+MERGED_BLUEPRINTS = {}
+
+def materialize_blueprint_overlays(base_file, overlay_files):
+    """Returns the path of the merged blueprint, a temporary file of this run to be removed by the caller."""
+    key = get_blueprint_overlay_key([base_file] + overlay_files)
+    # each unique combination of base and overlay contents is merged once per process, and once across runs with
+    # the blueprint cache. The cache entry itself is not passed to protect-hybrid-js, other runs may evict it
+    # before it is read.
+    json_str = MERGED_BLUEPRINTS.get(key)
+    if json_str is None:
+        cache_folder = get_blueprint_cache_folder()
+        json_str = None if cache_folder is None else read_blueprint_cache(cache_folder, key)
+        if json_str is None:
+            merged = load_json_from_file(base_file)
+            for overlay_file in overlay_files:
+                merged = merge_blueprint(merged, load_json_from_file(overlay_file))
+            json_str = json.dumps(merged, indent=2)
+            if cache_folder is not None:
+                write_blueprint_cache(cache_folder, key, json_str)
+        MERGED_BLUEPRINTS[key] = json_str
+
+    fd, merged_file = tempfile.mkstemp(prefix='protect-hybrid-', suffix='.merged.json')
+    with os.fdopen(fd, 'w', encoding='utf-8') as json_file:
+        json_file.write(json_str)
+    return merged_file
+
 # # # Utils # # #
 
 
 def remove_dir(dir_name):
     if os.path.isdir(dir_name):
         shutil.rmtree(dir_name)
+    release_temporary_folder(dir_name)
+
+
+RAM_WORKSPACE = "ram"
+RAM_WORKSPACE_FOLDERS = ["/dev/shm", "/run/shm"]
+WORKSPACE_FREE_SPACE_RATIO = 2.2  # extracted entries, the copy protect-hybrid-js writes and repack spools
+
+
+def get_workspace_folder(workspace, required_size):
+    """Returns the folder for the temporary files of a run, None for the default temporary folder.
+    'ram' selects a RAM-backed folder. Workspaces with less free space than required_size fall back to the default."""
+    if workspace is None:
+        return None
+    if workspace.lower() == RAM_WORKSPACE:
+        ram_folders = [folder for folder in RAM_WORKSPACE_FOLDERS if os.path.isdir(folder)]
+        if len(ram_folders) == 0:
+            print('No RAM-backed folder found, using the default temporary folder.')
+            return None
+        workspace = ram_folders[0]
+    try:
+        os.makedirs(workspace, exist_ok=True)
+        free_size = shutil.disk_usage(workspace).free
+    except OSError as e:
+        raise ValueError('Unable to use the workspace "{}": {}'.format(workspace, e))
+    if free_size < required_size * WORKSPACE_FREE_SPACE_RATIO:
+        print('Workspace "{}" has {} MB free, {} MB needed: using the default temporary folder.'
+              .format(workspace, free_size // (1024 * 1024), int(required_size * WORKSPACE_FREE_SPACE_RATIO) // (1024 * 1024)))
+        return None
+    print('Using the workspace "{}".'.format(workspace))
+    return workspace
+
+
+FICLONE = 0x40049409  # Linux ioctl, _IOW(0x94, 9, int)
+
+
+def clone_file(source, target):
+    """Copies source to target as shutil.copy2, as a copy-on-write clone (reflink) where the file system supports it."""
+    if sys.platform == 'darwin':
+        try:
+            # clonefile(2), APFS
+            if ctypes.CDLL(None, use_errno=True).clonefile(os.fsencode(source), os.fsencode(target), 0) == 0:
+                return target
+        except (AttributeError, OSError):
+            pass
+    elif fcntl is not None:
+        try:
+            with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+                fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            shutil.copystat(source, target)
+            return target
+        except OSError:
+            pass
+    return shutil.copy2(source, target)
+
+
+def clone_tree(source_folder, target_folder, hardlink_patterns=(), hardlink_skip_patterns=()):
+    """Copies source_folder to target_folder as shutil.copytree, cloning files where the file system supports it.
+    Files matching hardlink_patterns and none of hardlink_skip_patterns (relative paths) are hardlinked instead,
+    only for files neither tree modifies later."""
+    def clone(source, target):
+        relative_path = os.path.relpath(source, source_folder).replace(os.sep, '/')
+        if (any(fnmatch.fnmatch(relative_path, pattern) for pattern in hardlink_patterns) and
+                not any(fnmatch.fnmatch(relative_path, pattern) for pattern in hardlink_skip_patterns)):
+            try:
+                os.link(source, target)
+                return target
+            except OSError:
+                pass
+        return clone_file(source, target)
+    return shutil.copytree(source_folder, target_folder, copy_function=clone)
+
+
+TEMPORARY_FOLDER_PREFIX = "protect-hybrid-"
+TEMPORARY_FOLDER_LOCK_SUFFIX = ".lock"
+TEMPORARY_FOLDER_LOCKS = {}  # temporary folder -> its lock file, held while the run uses the folder
+TRASH_FOLDER_NAME = "protect-hybrid-trash"
+EMPTY_TRASH_SCRIPT = ("import os, shutil, sys\n"
+                      "for name in os.listdir(sys.argv[1]):\n"
+                      "    shutil.rmtree(os.path.join(sys.argv[1], name), ignore_errors=True)\n")
+
+
+# The lock file next to the folder is locked (flock, also across hosts sharing the folder over NFS) until the folder is
+# removed, so folders left by crashed runs are the ones whose lock can be taken. It is kept out of the folder, whose
+# content is protected and repacked. The lock file is locked before it gets its name.
+def make_temporary_folder(workspace=None):
+    folder = tempfile.mkdtemp(prefix="{}{}-".format(TEMPORARY_FOLDER_PREFIX, os.getpid()), dir=workspace)
+    if fcntl is not None:
+        lock_path = folder + TEMPORARY_FOLDER_LOCK_SUFFIX
+        lock_file = open(lock_path + ".new", 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(lock_path + ".new", lock_path)
+        TEMPORARY_FOLDER_LOCKS[folder] = lock_file
+    return folder
+
+
+def release_temporary_folder(folder):
+    lock_file = TEMPORARY_FOLDER_LOCKS.pop(folder, None)
+    if lock_file is not None:
+        remove_file_if_exists(folder + TEMPORARY_FOLDER_LOCK_SUFFIX)
+        lock_file.close()
+
+
+def remove_file_if_exists(file_name):
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+
+
+def move_to_trash(dir_name):
+    """Renames dir_name into the trash folder next to it, returns the trash folder or None if it could not be moved."""
+    trash_folder = os.path.join(os.path.dirname(os.path.abspath(dir_name)), TRASH_FOLDER_NAME)
+    try:
+        os.makedirs(trash_folder, exist_ok=True)
+        os.rename(dir_name, os.path.join(trash_folder, os.path.basename(dir_name)))
+    except OSError:
+        return None
+    return trash_folder
+
+
+def reap_temporary_folders(folder):
+    """Moves the temporary folders no run holds the lock of (crashed or killed runs) into the trash and removes their
+    lock files. Folders without a lock file are left alone."""
+    if fcntl is None:
+        return
+    for name in os.listdir(folder):
+        if not name.startswith(TEMPORARY_FOLDER_PREFIX) or not name.endswith(TEMPORARY_FOLDER_LOCK_SUFFIX):
+            continue
+        lock_path = os.path.join(folder, name)
+        try:
+            lock_fd = os.open(lock_path, os.O_RDWR)
+        except OSError:
+            continue
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            temporary_folder = lock_path[:-len(TEMPORARY_FOLDER_LOCK_SUFFIX)]
+            if os.path.isdir(temporary_folder):
+                move_to_trash(temporary_folder)
+            remove_file_if_exists(lock_path)
+        except OSError:
+            pass  # in use
+        finally:
+            os.close(lock_fd)
+
+
+def remove_dirs_in_background(dir_names):
+    """Moves the folders into the trash and empties it in a detached process, together with leftovers of crashed runs.
+    Folders which cannot be moved are removed right away."""
+    trash_folders = set()
+    for dir_name in dir_names:
+        if not os.path.isdir(dir_name):
+            release_temporary_folder(dir_name)
+            continue
+        trash_folder = move_to_trash(dir_name)
+        if trash_folder is None:
+            remove_dir(dir_name)
+        else:
+            release_temporary_folder(dir_name)
+            trash_folders.add(trash_folder)
+    for trash_folder in trash_folders:
+        reap_temporary_folders(os.path.dirname(trash_folder))
+        subprocess.Popen([sys.executable, '-c', EMPTY_TRASH_SCRIPT, trash_folder], stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def resolve_ignore_paths(ignore_paths, input_folder):
+    """Ignore paths which exist as given are kept, the others are resolved relative to the input folder.
+    Input folder is resolved once and only paths starting with an entry of the working directory are checked on disk."""
+    input_realpath = os.path.realpath(input_folder)
+    try:
+        # lower case, a case insensitive file system still gets the final os.path.exists check
+        working_directory_entries = set(entry.lower() for entry in os.listdir(os.curdir))
+        working_directory_entries.update([os.curdir, os.pardir])
+    except OSError:
+        working_directory_entries = None
+    resolved_paths = {}
+    for path in ignore_paths:
+        if path in resolved_paths:
+            continue
+        if working_directory_entries is None or os.path.isabs(path):
+            exists = os.path.exists(path)
+        else:
+            first_component = re.split(r'[\\/]', path, 1)[0].lower()
+            exists = first_component in working_directory_entries and os.path.exists(path)
+        resolved_paths[path] = path if exists else os.path.join(input_realpath, path.strip("/"))
+    return resolved_paths
 
 
 def get_from_path(file_name):
@@ -595,46 +1105,62 @@ def get_default_protect_android_blueprint_json(isAAB):
                 }]
             }}
 
-def add_code_lifting_class_to_android_blueprint(protect_android_blueprint_copy, protect_android_json, target_type, protect_hybrid_blueprint):
-
-    if protect_hybrid_blueprint is None:
-        return
-
-    hybrid_blueprint = load_json_from_file(protect_hybrid_blueprint)
-    global_config = get_insensitive(hybrid_blueprint, "globalConfiguration")
-    guard_configs = get_insensitive(hybrid_blueprint, "guardConfigurations")
+def get_code_lifting_secrets_path(app_id):
+    if sys.platform == "win32":
+        return os.path.expandvars(R"C:\Users\$USERNAME\AppData\Local\Arxan\ArxanForHybrid\.{}".format(app_id))
+    return os.path.expanduser('~/.arxan/ArxanForHybrid/.{}'.format(app_id))
 
+def is_code_lifting_enabled(guard_configs):
     code_lifting_enabled = False
     for config in guard_configs:
         guard_config = get_insensitive(guard_configs, config)
         code_lifting_config = get_insensitive(guard_config, "codeLiftingDetection")
         if code_lifting_config is None:
             continue
-        elif type(code_lifting_config) is dict:
+        elif isinstance(code_lifting_config, dict):
             if get_insensitive(code_lifting_config, "enable") is True:
                 code_lifting_enabled = True
-        elif type(code_lifting_config) is list:
+        elif isinstance(code_lifting_config, list):
             for cl_config in code_lifting_config:
                 if get_insensitive(cl_config, "enable") is True:
                     code_lifting_enabled = True
                     break
         else:
             raise ValueError("Invalid Code Lifting Detection configuration found. Configuration only accepts an object or an array, but a literal has been found.")
+    return code_lifting_enabled
+
+def get_code_lifting_target_type(target_type, target):
+    target_name = target.lower() if isinstance(target, str) else None
+    if (target_type == TargetType.CORDOVA or target_name == 'cordova-android'):
+        return TargetType.CORDOVA
+    elif(target_type == TargetType.IONIC or target_name == 'ionic-android'):
+        raise ValueError('Code Lifting Detection guard is not implemented for "{}" target.'.format(target))
+    elif(target_type == TargetType.NATIVESCRIPT or target_name == 'nativescript-android'):
+        return TargetType.NATIVESCRIPT
+    elif(target_type == TargetType.REACT_NATIVE or target_name == 'reactnative-android'):
+        return TargetType.REACT_NATIVE
+    raise ValueError('Unable to find configuration for target: "{}".'.format(target))
+
+def add_code_lifting_class_to_android_blueprint(protect_android_blueprint_copy, protect_android_json, target_type, protect_hybrid_blueprint):
 
-    if not code_lifting_enabled:
+    if protect_hybrid_blueprint is None:
+        return
+
+    hybrid_blueprint = load_json_from_file(protect_hybrid_blueprint)
+    global_config = get_insensitive(hybrid_blueprint, "globalConfiguration")
+    guard_configs = get_insensitive(hybrid_blueprint, "guardConfigurations")
+
+    if not is_code_lifting_enabled(guard_configs):
         return
 
     app_id = get_insensitive(global_config, "appid")
     target = get_insensitive(global_config, "targettype")
 
-    if sys.platform == "win32":
-        with open(os.path.expandvars(R"C:\Users\$USERNAME\AppData\Local\Arxan\ArxanForHybrid\.{}".format(app_id)), 'r') as file:
-            vars = json.loads(file.read())
-    else:
-        with open(os.path.expanduser('~/.arxan/ArxanForHybrid/.{}'.format(app_id)), 'r') as file:
-            vars = json.loads(file.read())
+    with open(get_code_lifting_secrets_path(app_id), 'r') as file:
+        vars = json.loads(file.read())
 
-    if (target_type == TargetType.CORDOVA or target.lower() == 'cordova-android'):
+    code_lifting_target_type = get_code_lifting_target_type(target_type, target)
+    if code_lifting_target_type == TargetType.CORDOVA:
         excludes = [
             {'type': 'method', 'name': 'cordova.plugin.' + vars["ARXAN_PLUGIN"] + '.' + vars["ARXAN_CLASS"] + '.' + vars["ARXAN_FUNCTION"]}
         ]
@@ -642,9 +1168,7 @@ def add_code_lifting_class_to_android_blueprint(protect_android_blueprint_copy,
         targets = [
             'cordova.plugin.' + vars["ARXAN_PLUGIN"] + '.' + vars["ARXAN_CLASS"]
         ]
-    elif(target_type == TargetType.IONIC or target.lower() == 'ionic-android'):
-        raise ValueError('Code Lifting Detection guard is not implemented for "{}" target.'.format(target))
-    elif(target_type == TargetType.NATIVESCRIPT or target.lower() == 'nativescript-android'):
+    elif code_lifting_target_type == TargetType.NATIVESCRIPT:
         excludes = [
             {'type': 'class', 'name': vars["ARXAN_PLUGIN"] + '.' + vars["ARXAN_CLASS"]}
         ]
@@ -654,7 +1178,7 @@ def add_code_lifting_class_to_android_blueprint(protect_android_blueprint_copy,
         targets = [
             vars["ARXAN_PLUGIN"] + '.' + vars["ARXAN_CLASS"]
         ]
-    elif(target_type == TargetType.REACT_NATIVE or target.lower() == 'reactnative-android'):
+    else:
         excludes = [
             {'type': 'class', 'name': 'com.' + vars["ARXAN_PLUGIN"] + '.'  + vars["ARXAN_CLASS"] + 'Module'},
         ]
@@ -665,8 +1189,6 @@ def add_code_lifting_class_to_android_blueprint(protect_android_blueprint_copy,
             'com.' + vars["ARXAN_PLUGIN"] + '.'  + vars["ARXAN_CLASS"] + 'Module',
             'com.' + vars["ARXAN_PLUGIN"] + '.'  + vars["ARXAN_CLASS"] + 'Package'
         ]
-    else:
-        raise ValueError('Unable to find configuration for target: "{}".'.format(target))
 
     guard_dict = protect_android_json["guardConfiguration"]
 
@@ -702,11 +1224,14 @@ def add_code_lifting_class_to_android_blueprint(protect_android_blueprint_copy,
     with open(protect_android_blueprint_copy, 'w') as output_json_file:
         json.dump(protect_android_json, output_json_file, indent=2)
 
+# Files protected by protect-hybrid-js and the Resource Verification Guard
+PROTECTABLE_FILE_PATTERNS = ["*assets*index.android.bundle", "*assets*.js", "*app*.js"]
+
 def add_protected_files_to_android_blueprint(tmp_folder, protect_android_blueprint_copy, protect_android_json, isAAB, tamper_action_type=None, tamper_action_method=None):
     # could achieve same result using regex and re.search(pattern, path_name) instead of fnmatch.fnmatch function
     #    include_patterns = [".+(assets).+(index.android.bundle)", ".+(assets).+(.js)"]
 
-    include_patterns = ["*assets*index.android.bundle", "*assets*.js", "*app*.js", ]
+    include_patterns = list(PROTECTABLE_FILE_PATTERNS)
     exclude_patterns = []
 
     print("\tInclude patterns:" + str(include_patterns))
@@ -765,6 +1290,72 @@ def validate_android_home_variable():
     if not os.environ.get('ANDROID_HOME'):
         raise ValueError("ANDROID_HOME variable not set.")
 
+
+CODE_LIFTING_SECRETS = ["ARXAN_PLUGIN", "ARXAN_CLASS", "ARXAN_FUNCTION"]
+
+def get_configuration_problems(protect_hybrid_blueprint, protect_android_blueprint, target_type, native_protection):
+    """Check blueprints, Code Lifting Detection plugin settings and target type before the APK/AAB is extracted.
+    Returns every problem found instead of stopping at the first one."""
+    problems = []
+
+    if native_protection and protect_android_blueprint is not None:
+        try:
+            if "guardConfiguration" not in load_json_from_file(protect_android_blueprint):
+                problems.append("Provided Digital.ai Android App Protection blueprint does not contain " +
+                                "'guardConfiguration' section.")
+        except ValueError as e:
+            problems.append(str(e))
+
+    if protect_hybrid_blueprint is None:
+        return problems
+    try:
+        hybrid_blueprint = load_json_from_file(protect_hybrid_blueprint)
+    except ValueError as e:
+        problems.append(str(e))
+        return problems
+
+    global_config = get_insensitive(hybrid_blueprint, "globalConfiguration")
+    target = get_insensitive(global_config, "targettype")
+    # Target type flag overrides the target type in the protect-hybrid-js blueprint
+    if target_type == TargetType.DEFAULT and target is not None:
+        if not isinstance(target, str) or target.lower() not in ANDROID_TARGET_TYPE_NAMES.values():
+            print('\tWarning: target type "{}" in the protect-hybrid-js blueprint is not an Android target. '.format(target) +
+                  'Use an Android target type or one of the -rn, -ns, -co, -io options.')
+
+    # Code Lifting Detection only changes the Digital.ai Android App Protection blueprint
+    if not native_protection:
+        return problems
+    guard_configs = get_insensitive(hybrid_blueprint, "guardConfigurations")
+    try:
+        if guard_configs is None or not is_code_lifting_enabled(guard_configs):
+            return problems
+    except ValueError as e:
+        problems.append(str(e))
+        return problems
+
+    try:
+        get_code_lifting_target_type(target_type, target)
+    except ValueError as e:
+        problems.append(str(e))
+
+    app_id = get_insensitive(global_config, "appid")
+    if app_id is None:
+        problems.append("Code Lifting Detection requires 'appID' in the 'globalConfiguration' section of the protect-hybrid-js blueprint.")
+        return problems
+    secrets_path = get_code_lifting_secrets_path(app_id)
+    try:
+        with open(secrets_path, 'r') as file:
+            secrets = json.loads(file.read())
+    except (OSError, ValueError):
+        problems.append('Unable to read Code Lifting Detection plugin settings at "{}". '.format(secrets_path) +
+                        'Make sure the plugin was installed for this appID using hybrid-install-plugin.py.')
+        return problems
+    missing_secrets = [name for name in CODE_LIFTING_SECRETS if name not in secrets]
+    if len(missing_secrets) > 0:
+        problems.append('Code Lifting Detection plugin settings at "{}" do not contain: {}.'
+                        .format(secrets_path, ", ".join(missing_secrets)))
+    return problems
+
 # # # Stdout # # #
 
 
@@ -778,95 +1369,724 @@ def print_section_end():
 # # # Zip/APK handling
 
 
-def decompress_with_report(zip_file: str, extracting_path: str):
-    compression_level = {}
-    file_list_in_zip_file = []
-    renamed_files = {}
-    zip_to_scan = zipfile.ZipFile(zip_file)
-    file_info = zip_to_scan.NameToInfo
-    is_extracting = len(extracting_path) > 0
-    for fileName, info in file_info.items():
-        if not info.filename.lower() in file_list_in_zip_file:
-            file_list_in_zip_file.append(info.filename.lower())
-        else:
-            name = info.filename[info.filename.rfind('/') + 1:info.filename.rfind('.')]
-            new_path = info.filename.replace(name, str(hash(info.filename) % 10 ** 8))
-            renamed_files[new_path] = info.filename
-            info.filename = new_path
+def get_selective_extraction_patterns(isAAB):
+    if isAAB:
+        return PROTECTABLE_FILE_PATTERNS + ['base/manifest/AndroidManifest.xml']
+    return PROTECTABLE_FILE_PATTERNS + ['AndroidManifest.xml']
+
+
+class ArchiveIndex:
+    """Entries of the input APK/AAB read once from its central directory: compression types, offsets and the names
+    used on disk, where entries colliding case insensitively with an earlier entry are renamed."""
+
+    def __init__(self, zip_file):
+        self.zip_file = zip_file
+        self.name_to_info = {}
+        self.lower_names = {}  # lower case name -> first entry with that name
+        self.extracted_names = {}  # entry name -> name on disk
+        self.renamed_files = {}  # name on disk -> entry name, for renamed entries only
+        self.extracted_stats = {}  # entry name -> size and modification time of the extracted file
+        with zipfile.ZipFile(zip_file) as zf:
+            self.comment = zf.comment
+            for info in zf.infolist():
+                self.name_to_info[info.filename] = info
+        for name, info in self.name_to_info.items():
+            lower_name = name.lower()
+            if lower_name not in self.lower_names:
+                self.lower_names[lower_name] = name
+                self.extracted_names[name] = name
+            else:
+                new_path = self.get_collision_name(name)
+                self.lower_names[new_path.lower()] = name
+                self.renamed_files[new_path] = name
+                self.extracted_names[name] = new_path
+
+    # Derived from the entry name only, so the same archive is always extracted to the same tree
+    def get_collision_name(self, name):
+        folder, separator, file_name = name.rpartition('/')
+        extension_start = file_name.rfind('.')
+        extension = file_name[extension_start:] if extension_start > 0 else ''
+        digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        for length in range(8, len(digest) + 1):
+            new_path = folder + separator + digest[:length] + extension
+            if new_path.lower() not in self.lower_names:
+                return new_path
+        raise ValueError('Unable to rename "{}" colliding with another entry.'.format(name))
+
+    def save_renamed_files(self, file_name):
+        with open(file_name, 'w') as output_json_file:
+            json.dump(dict(sorted(self.renamed_files.items())), output_json_file, indent=2)
+
+    def get_info(self, name):
+        return self.name_to_info.get(name)
+
+    def get_compression_type(self, name, default=zipfile.ZIP_DEFLATED):
+        info = self.name_to_info.get(name)
+        return default if info is None else info.compress_type
+
+    def get_original_name(self, extracted_name):
+        return self.renamed_files.get(extracted_name, extracted_name)
+
+    # through the indexed entry, the central directory is not read again
+    def read(self, name):
+        if name not in self.name_to_info:
+            raise ValueError('Unable to find "{}" in "{}".'.format(name, self.zip_file))
+        info = self.name_to_info[name]
+        if not can_inflate(info):
+            with zipfile.ZipFile(self.zip_file) as zf:
+                return zf.read(info)
+        data = io.BytesIO()
+        with open(self.zip_file, 'rb') as source_fp:
+            inflate_entry(source_fp, info, data, ZIP_BUFFER_SIZE_MB * 1024 * 1024)
+        return data.getvalue()
+
+    # extract_patterns: only matching entries are extracted
+    def get_extracted_infos(self, extract_patterns=None):
+        return [info for name, info in self.name_to_info.items()
+                if extract_patterns is None or any(fnmatch.fnmatch(name, pattern) for pattern in extract_patterns)]
+
+    def get_extracted_size(self, extract_patterns=None):
+        return sum(info.file_size for info in self.get_extracted_infos(extract_patterns))
+
+
+# Path of an extracted entry, sanitized as by ZipFile.extract: no absolute paths, drives or parent folders.
+def get_extracted_path(extracting_path: str, extracted_name: str):
+    name = os.path.splitdrive(extracted_name.replace('/', os.sep))[1]
+    parts = [part for part in name.split(os.sep) if part not in ('', os.curdir, os.pardir)]
+    return os.path.join(extracting_path, *parts)
+
+
+def seek_entry_data(source_fp, info):
+    # local header of the entry may have a different extra field than its central directory record
+    source_fp.seek(info.header_offset)
+    header = source_fp.read(30)
+    if len(header) < 30 or header[:4] != zipfile.stringFileHeader:
+        raise ValueError('Invalid local header of "{}" in the source archive.'.format(info.filename))
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    source_fp.seek(info.header_offset + 30 + name_length + extra_length)
+
+
+def can_inflate(info):
+    return info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) and not info.flag_bits & 0x1  # not encrypted
+
+
+# Stored and deflated entries are copied or inflated from their raw data, their size and CRC are checked against the
+# central directory as ZipFile does, so a corrupt source archive is never repacked.
+def inflate_entry(source_fp, info, target, buffer_size: int):
+    seek_entry_data(source_fp, info)
+    decompressor = zlib.decompressobj(-15) if info.compress_type == zipfile.ZIP_DEFLATED else None
+    remaining = info.compress_size
+    crc = 0
+    while remaining > 0:
+        chunk = source_fp.read(min(buffer_size, remaining))
+        if len(chunk) == 0:
+            raise ValueError('Unexpected end of data of "{}".'.format(info.filename))
+        remaining -= len(chunk)
+        if decompressor is None:
+            crc = zlib.crc32(chunk, crc)
+            target.write(chunk)
+            continue
+        data = decompressor.decompress(chunk, buffer_size)
+        while True:
+            crc = zlib.crc32(data, crc)
+            target.write(data)
+            if not decompressor.unconsumed_tail:
+                break
+            data = decompressor.decompress(decompressor.unconsumed_tail, buffer_size)
+    if decompressor is not None:
+        data = decompressor.flush()
+        crc = zlib.crc32(data, crc)
+        target.write(data)
+    if target.tell() != info.file_size or crc != info.CRC:
+        raise ValueError('Invalid data of "{}" in the source archive.'.format(info.filename))
+
+
+# Returns entry name -> size and modification time of the extracted files
+def extract_entries_with_handle(zip_file: str, entries, buffer_size: int):
+    extracted_stats = {}
+    zip_to_extract = None
+    try:
+        with open(zip_file, 'rb') as source_fp:
+            for info, target_file in entries:
+                with open(target_file, 'wb') as target:
+                    if can_inflate(info):
+                        inflate_entry(source_fp, info, target, buffer_size)
+                    else:
+                        zip_to_extract = zip_to_extract or zipfile.ZipFile(zip_file)
+                        with zip_to_extract.open(info) as source:
+                            shutil.copyfileobj(source, target, buffer_size)
+                stat = os.stat(target_file)
+                extracted_stats[info.filename] = (stat.st_size, stat.st_mtime_ns)
+    finally:
+        if zip_to_extract is not None:
+            zip_to_extract.close()
+    return extracted_stats
+
+
+# Entries are inflated by a pool of workers, each with its own handle to the archive. Folders are created upfront
+# from the index and entries are written directly to their paths.
+def extract_entries(index, extracting_path: str, extract_patterns=None, workers=None, buffer_size_mb=None):
+    workers = workers or os.cpu_count() or 1
+    buffer_size = (buffer_size_mb or ZIP_BUFFER_SIZE_MB) * 1024 * 1024
+
+    folders = set()
+    entries = []
+    for info in index.get_extracted_infos(extract_patterns):
+        target_file = get_extracted_path(extracting_path, index.extracted_names[info.filename])
+        if info.filename.endswith("/"):
+            folders.add(target_file)
+        elif target_file != extracting_path:
+            folders.add(os.path.dirname(target_file))
+            entries.append((info, target_file))
+    for folder in sorted(folders):
+        os.makedirs(folder, exist_ok=True)
+
+    # largest entries first, each to the least loaded worker
+    worker_entries = [[] for _ in range(min(workers, len(entries)))]
+    worker_sizes = [0] * len(worker_entries)
+    for info, target_file in sorted(entries, key=lambda entry: entry[0].file_size, reverse=True):
+        idx = worker_sizes.index(min(worker_sizes))
+        worker_entries[idx].append((info, target_file))
+        worker_sizes[idx] += info.file_size + 1
+    if len(worker_entries) <= 1:
+        for assigned in worker_entries:
+            index.extracted_stats.update(extract_entries_with_handle(index.zip_file, assigned, buffer_size))
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(worker_entries)) as executor:
+        futures = [executor.submit(extract_entries_with_handle, index.zip_file, assigned, buffer_size)
+                   for assigned in worker_entries]
+        for future in futures:
+            index.extracted_stats.update(future.result())
 
-        compression_level[fileName] = info.compress_type
-        if is_extracting:
-            zip_to_scan.extract(info, extracting_path)
 
-    return compression_level, renamed_files
+ZIP_BUFFER_SIZE_MB = 1
+# zipalign: stored entries start at 4 byte boundaries, stored native libraries at page boundaries
+# so they can be mapped directly from the APK (extractNativeLibs=false)
+ZIP_ALIGNMENT = 4
+ZIP_PAGE_ALIGNMENT_KB = 16
+ZIP_ALIGNMENT_EXTRA_ID = 0xd935
+ZIP64_EXTRA_ID = 0x0001
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
 
 
-def compress_dir(out_dir: str, out_zip_file: str, compress_level_table, renamed_files):
-    is_windows = platform.system() == "Windows"
-    with zipfile.ZipFile(out_zip_file, mode='w') as zf:
-        # Iterate over all the files in directory
-        for folderName, subfolders, filenames in os.walk(out_dir):
-            for filename in filenames:
-                # create complete filepath of file in directory
-                target_file = os.path.join(folderName, filename)
-                file_in_zip = os.path.relpath(target_file, out_dir)
-                key = file_in_zip.replace('\\', '/') if is_windows else file_in_zip
-                if key in renamed_files:
-                    file_in_zip = renamed_files.get(key)
-                    if is_windows:
-                        file_in_zip = file_in_zip.replace('/', '\\')
+def strip_extra_fields(extra, extra_ids):
+    fields = []
+    idx = 0
+    while idx + 4 <= len(extra):
+        field_id, size = struct.unpack('<HH', extra[idx:idx + 4])
+        if field_id not in extra_ids:
+            fields.append(extra[idx:idx + 4 + size])
+        idx += 4 + size
+    fields.append(extra[idx:])
+    return b''.join(fields)
+
+
+# Central directory record of the source entry for the repacked one. Sizes, CRC and offset are set when the entry
+# is written, the Zip64 and alignment fields are added again if still needed and no data descriptor follows the data.
+def copy_entry_info(source_info):
+    info = copy.copy(source_info)
+    info.flag_bits &= ~ZIP_DATA_DESCRIPTOR_FLAG
+    info.extra = strip_extra_fields(source_info.extra, (ZIP64_EXTRA_ID, ZIP_ALIGNMENT_EXTRA_ID))
+    return info
+
+
+class ZipRepackWriter:
+    """Zip writer used for repacking. Entries are either copied from the source archive as they are (compressed data,
+    CRC, sizes and compression method) or compressed from the protected files."""
+
+    def __init__(self, zip_file, buffer_size, page_alignment=None):
+        self.fp = open(zip_file, 'wb')
+        self.buffer_size = buffer_size
+        self.page_alignment = page_alignment  # None: no alignment (AAB)
+        self.entries = []
+
+    def get_alignment(self, info):
+        if self.page_alignment is None or info.compress_type != zipfile.ZIP_STORED or info.filename.endswith('/'):
+            return None
+        if info.filename.endswith('.so'):
+            return self.page_alignment
+        return ZIP_ALIGNMENT
+
+    def write_local_header(self, info):
+        info.header_offset = self.fp.tell()
+        header = info.FileHeader()
+        alignment = self.get_alignment(info)
+        if alignment is not None:
+            # padding goes to the local header only, the central directory record keeps the entry's extra field
+            data_offset = info.header_offset + len(header) + 6
+            padding = (alignment - data_offset % alignment) % alignment
+            extra = info.extra
+            info.extra = extra + struct.pack('<HHH', ZIP_ALIGNMENT_EXTRA_ID, 2 + padding, alignment) + bytes(padding)
+            header = info.FileHeader()
+            info.extra = extra
+        self.fp.write(header)
+        self.entries.append(info)
+
+    def copy_raw(self, info, source_fp, source_info):
+        seek_entry_data(source_fp, source_info)
+
+        info.compress_type = source_info.compress_type
+        info.CRC = source_info.CRC
+        info.compress_size = source_info.compress_size
+        info.file_size = source_info.file_size
+        self.write_local_header(info)
+        self.copy_stream(source_fp, source_info.compress_size, source_info.filename)
+
+    # stream: compressed data of the entry, read from its current position
+    def write_stream(self, info, compress_type, crc, file_size, compress_size, stream):
+        info.compress_type = compress_type
+        info.CRC = crc
+        info.file_size = file_size
+        info.compress_size = compress_size
+        self.write_local_header(info)
+        self.copy_stream(stream, compress_size, info.filename)
+
+    def copy_stream(self, stream, size, filename):
+        remaining = size
+        while remaining > 0:
+            chunk = stream.read(min(self.buffer_size, remaining))
+            if len(chunk) == 0:
+                raise ValueError('Unexpected end of data of "{}".'.format(filename))
+            self.fp.write(chunk)
+            remaining -= len(chunk)
+
+    def close(self, comment=b''):
+        start_dir = self.fp.tell()
+        for info in self.entries:
+            dt = info.date_time
+            dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+            dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+            file_size = info.file_size
+            compress_size = info.compress_size
+            header_offset = info.header_offset
+            zip64_fields = []
+            if file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT:
+                zip64_fields.extend([file_size, compress_size])
+                file_size = compress_size = 0xffffffff
+            if header_offset > zipfile.ZIP64_LIMIT:
+                zip64_fields.append(header_offset)
+                header_offset = 0xffffffff
+            extra = info.extra
+            extract_version = info.extract_version
+            if len(zip64_fields) > 0:
+                extra = struct.pack('<HH' + 'Q' * len(zip64_fields), 1, 8 * len(zip64_fields), *zip64_fields) + extra
+                extract_version = max(zipfile.ZIP64_VERSION, extract_version)
+            try:
+                filename = info.filename.encode('ascii')
+                flag_bits = info.flag_bits
+            except UnicodeEncodeError:
+                filename = info.filename.encode('utf-8')
+                flag_bits = info.flag_bits | 0x800
+            central_directory = struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir,
+                                            max(info.create_version, extract_version), info.create_system,
+                                            extract_version, info.reserved, flag_bits, info.compress_type,
+                                            dostime, dosdate, info.CRC, compress_size, file_size,
+                                            len(filename), len(extra), len(info.comment), 0,
+                                            info.internal_attr, info.external_attr, header_offset)
+            self.fp.write(central_directory + filename + extra + info.comment)
+
+        end_dir = self.fp.tell()
+        entries_count = len(self.entries)
+        central_directory_size = end_dir - start_dir
+        central_directory_offset = start_dir
+        if (entries_count > zipfile.ZIP_FILECOUNT_LIMIT or central_directory_offset > zipfile.ZIP64_LIMIT or
+                central_directory_size > zipfile.ZIP64_LIMIT):
+            self.fp.write(struct.pack(zipfile.structEndArchive64, zipfile.stringEndArchive64,
+                                      44, zipfile.ZIP64_VERSION, zipfile.ZIP64_VERSION, 0, 0,
+                                      entries_count, entries_count, central_directory_size, central_directory_offset))
+            self.fp.write(struct.pack(zipfile.structEndArchive64Locator, zipfile.stringEndArchive64Locator,
+                                      0, end_dir, 1))
+            entries_count = min(entries_count, 0xffff)
+            central_directory_size = min(central_directory_size, 0xffffffff)
+            central_directory_offset = min(central_directory_offset, 0xffffffff)
+        comment = comment[:zipfile.ZIP_MAX_COMMENT]
+        self.fp.write(struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, entries_count, entries_count,
+                                  central_directory_size, central_directory_offset, len(comment)))
+        self.fp.write(comment)
+        self.fp.close()
+
+
+CRC_CHUNK_SIZE_MB = 16
+
+
+def gf2_matrix_times(matrix, vector):
+    result = 0
+    idx = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[idx]
+        vector >>= 1
+        idx += 1
+    return result
+
+
+def gf2_matrix_square(matrix):
+    return [gf2_matrix_times(matrix, matrix[n]) for n in range(32)]
+
+
+# Operator appending length zero bytes to a CRC-32, as in zlib's crc32_combine
+def get_crc32_shift(length):
+    power = [0xedb88320] + [1 << n for n in range(31)]  # one zero bit
+    for _ in range(3):
+        power = gf2_matrix_square(power)
+    shift = [1 << n for n in range(32)]
+    while length:
+        if length & 1:
+            shift = [gf2_matrix_times(power, shift[n]) for n in range(32)]
+        power = gf2_matrix_square(power)
+        length >>= 1
+    return shift
+
+
+def get_range_crc32(file_name, offset, size, buffer_size):
+    crc = 0
+    with open(file_name, 'rb') as in_file:
+        in_file.seek(offset)
+        while size > 0:
+            chunk = in_file.read(min(buffer_size, size))
+            if len(chunk) == 0:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size -= len(chunk)
+    return crc
+
+
+# Files larger than CRC_CHUNK_SIZE_MB are split in chunks checksummed by the threads of crc_executor and combined in order.
+# crc_executor is shared by all the files of a repack, it must not be the executor running the caller.
+def get_file_crc32(file_name, buffer_size, crc_executor=None):
+    file_size = os.path.getsize(file_name)
+    chunk_size = CRC_CHUNK_SIZE_MB * 1024 * 1024
+    if crc_executor is None or file_size <= chunk_size:
+        return get_range_crc32(file_name, 0, file_size, buffer_size)
+    offsets = range(0, file_size, chunk_size)
+    chunk_crcs = crc_executor.map(lambda offset: get_range_crc32(file_name, offset, chunk_size, buffer_size), offsets)
+    chunk_shift = get_crc32_shift(chunk_size)
+    last_size = file_size - offsets[-1]
+    crc = 0
+    for offset, chunk_crc in zip(offsets, chunk_crcs):
+        shift = chunk_shift if offset != offsets[-1] else get_crc32_shift(last_size)
+        crc = gf2_matrix_times(shift, crc) ^ chunk_crc
+    return crc
+
+
+# Files with the size and modification time they had when extracted are unchanged, on file systems with sub-second
+# timestamps: files rewritten within the same second could not be told apart otherwise. Only files left in the
+# extraction folder keep them, the copy written by protect-hybrid-js is compared by CRC in prepare_entry.
+def is_file_untouched(stat, source_info, extracted_stat):
+    if source_info is None or stat.st_size != source_info.file_size:
+        return False
+    return extracted_stat == (stat.st_size, stat.st_mtime_ns) and stat.st_mtime_ns % 1000000000 != 0
+
+
+# Runs in a worker thread (zlib releases the GIL): None for a file with the size and CRC of its source entry, otherwise
+# the compression type, CRC, size and compressed size of the file plus its compressed data spool (None when stored).
+# The CRC of a file is computed once: files up to buffer_size are read once and compressed from memory if changed.
+# Larger files with the size of their source entry are checksummed first, so unchanged ones are not compressed for
+# nothing, and read again only if changed. Spools move to disk past buffer_size, so memory does not grow with file size.
+# extracted_stat: size and modification time of the file when extracted, crc_executor: threads checksumming large files
+def prepare_entry(target_file, source_info, compress_type, buffer_size, temporary_folder=None, extracted_stat=None,
+                  crc_executor=None, compress_level=zlib.Z_DEFAULT_COMPRESSION):
+    stat = os.stat(target_file)
+    if is_file_untouched(stat, source_info, extracted_stat):
+        return None
+    same_size = source_info is not None and stat.st_size == source_info.file_size
+    data = None
+    crc = None
+    if stat.st_size <= buffer_size:
+        with open(target_file, "rb") as in_file:
+            data = in_file.read()
+        crc = zlib.crc32(data)
+    elif same_size or compress_type == zipfile.ZIP_STORED:
+        crc = get_file_crc32(target_file, buffer_size, crc_executor)
+    if same_size and crc == source_info.CRC:
+        return None
+    if compress_type == zipfile.ZIP_STORED:
+        return compress_type, crc, stat.st_size, stat.st_size, None
+
+    # APK/AAB entries are either stored or deflated
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    spool = tempfile.SpooledTemporaryFile(max_size=buffer_size, dir=temporary_folder)
+    if data is not None:
+        spool.write(compressor.compress(data))
+    else:
+        file_crc = 0
+        with open(target_file, "rb") as in_file:
+            while True:
+                chunk = in_file.read(buffer_size)
+                if len(chunk) == 0:
+                    break
+                if crc is None:
+                    file_crc = zlib.crc32(chunk, file_crc)
+                spool.write(compressor.compress(chunk))
+        crc = file_crc if crc is None else crc
+    spool.write(compressor.flush())
+    compress_size = spool.tell()
+    spool.seek(0)
+    return zipfile.ZIP_DEFLATED, crc, stat.st_size, compress_size, spool
 
-                # Add file to zip
-                info = zipfile.ZipInfo(file_in_zip, date_time=time.localtime(time.time()))
 
-                in_file = open(target_file, "rb")
-                file_content_data = in_file.read()
-                in_file.close()
+ZIP_MINIMUM_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
-                key = file_in_zip.replace('\\', '/') if is_windows else file_in_zip
-                compression_type = compress_level_table.get(key, zipfile.ZIP_DEFLATED)
 
-                info.compress_type = compression_type
-                info.create_system = 0
-                zf.writestr(info, file_content_data)
+# SOURCE_DATE_EPOCH (https://reproducible-builds.org/specs/source-date-epoch/) timestamp for every entry, if set
+def get_source_date_epoch():
+    source_date_epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if not source_date_epoch:
+        return None
+    try:
+        # zip timestamps start in 1980
+        return time.gmtime(max(int(source_date_epoch), 315532800))[:6]
+    except ValueError:
+        raise ValueError('Invalid SOURCE_DATE_EPOCH value: "{}".'.format(source_date_epoch))
+
+
+# # # Compression policy # # #
+
+
+COMPRESSION_SOURCE = "source"  # compression type of the source entry, deflate for new files
+COMPRESSION_TYPES = {COMPRESSION_SOURCE: None, "store": zipfile.ZIP_STORED, "deflate": zipfile.ZIP_DEFLATED}
+
+# already compressed media gains nothing from deflate
+DEFAULT_COMPRESSION_RULES = [
+    {"pattern": "*.png", "compression": "store"},
+    {"pattern": "*.jpg", "compression": "store"},
+    {"pattern": "*.jpeg", "compression": "store"},
+    {"pattern": "*.webp", "compression": "store"},
+    {"pattern": "*.gif", "compression": "store"},
+    {"pattern": "*.mp3", "compression": "store"},
+    {"pattern": "*.mp4", "compression": "store"},
+    {"pattern": "*.m4a", "compression": "store"},
+    {"pattern": "*.ogg", "compression": "store"},
+    {"pattern": "*.webm", "compression": "store"},
+]
+
+
+class CompressionRule:
+    def __init__(self, pattern, compression=COMPRESSION_SOURCE, level=zlib.Z_DEFAULT_COMPRESSION):
+        if not isinstance(pattern, str) or len(pattern) == 0:
+            raise ValueError('Compression rule pattern must be a non-empty string, got {}.'.format(json.dumps(pattern)))
+        if compression not in COMPRESSION_TYPES:
+            raise ValueError('Compression of rule "{}" must be one of {}.'.format(pattern, ", ".join(COMPRESSION_TYPES)))
+        if isinstance(level, bool) or not isinstance(level, int) or not -1 <= level <= 9:
+            raise ValueError('Deflate level of rule "{}" must be an integer from 0 to 9.'.format(pattern))
+        self.pattern = pattern
+        self.compression = compression
+        self.level = level
+        self.entries = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.seconds = 0.0
+
+    def matches(self, name):
+        return fnmatch.fnmatch(name.lower(), self.pattern.lower())
+
+    def get_compression_type(self, source_compression_type):
+        compression_type = COMPRESSION_TYPES[self.compression]
+        return source_compression_type if compression_type is None else compression_type
+
+    def get_description(self):
+        description = '"{}" {}'.format(self.pattern, self.compression)
+        if self.level != zlib.Z_DEFAULT_COMPRESSION:
+            description += ", level {}".format(self.level)
+        return description
+
+
+class CompressionPolicy:
+    """Compression type and deflate level of the entries compressed again when repacking: the first rule matching
+    the entry name (glob, case insensitive) applies, rules of the policy file before the built-in ones.
+    Unchanged entries are copied from the source archive as they are."""
+
+    def __init__(self, file_name=None):
+        self.rules = []
+        if file_name is not None:
+            policy = load_json_from_file(file_name)
+            if not isinstance(policy, dict):
+                raise ValueError('Compression policy "{}" must be an object.'.format(file_name))
+            rules = get_insensitive(policy, "rules")
+            if not isinstance(rules, list):
+                raise ValueError('Compression policy "{}" must have a "rules" array.'.format(file_name))
+            for rule in rules:
+                if not isinstance(rule, dict):
+                    raise ValueError('Compression policy "{}" rules must be objects.'.format(file_name))
+                self.rules.append(self.create_rule(rule))
+        self.rules.extend(self.create_rule(rule) for rule in DEFAULT_COMPRESSION_RULES)
+        self.rules.append(CompressionRule("*"))
+        self.copied_entries = 0
+        self.copied_size = 0
+
+    @staticmethod
+    def create_rule(rule):
+        compression = get_insensitive(rule, "compression")
+        level = get_insensitive(rule, "level")
+        return CompressionRule(get_insensitive(rule, "pattern"),
+                               COMPRESSION_SOURCE if compression is None else compression,
+                               zlib.Z_DEFAULT_COMPRESSION if level is None else level)
+
+    def get_rule(self, name):
+        for rule in self.rules:
+            if rule.matches(name):
+                return rule
+
+    def add_copied(self, source_info):
+        self.copied_entries += 1
+        self.copied_size += source_info.compress_size
+
+    def get_report(self):
+        lines = []
+        for rule in self.rules:
+            if rule.entries > 0:
+                lines.append('{}: {} entries, {} -> {} bytes in {:.2f}s'.format(
+                    rule.get_description(), rule.entries, rule.file_size, rule.compress_size, rule.seconds))
+        lines.append('copied unchanged: {} entries, {} bytes'.format(self.copied_entries, self.copied_size))
+        return lines
+
+
+# Files with the same size and CRC as their entry in the indexed archive are copied compressed from it, only files changed
+# by protect-hybrid-js are compressed again. copy_missing: entries not found in out_dir are copied too (selective extraction)
+# Entries keep the order and metadata of the indexed archive (directories included), new files follow sorted by name.
+# Peak memory is about 2 * workers * buffer_size_mb, whatever the size of the entries. Large files are checksummed by
+# another pool of workers threads shared by all entries, so a repack never runs more than 2 * workers threads.
+# page_alignment_kb: stored entries are aligned as by zipalign, native libraries to pages of this size (None for AAB)
+# temporary_folder: folder of the spools moved to disk (default: temporary folder)
+# compression_policy: compression of the files compressed again, its rules count their entries, bytes and time
+def compress_dir(out_dir: str, out_zip_file: str, index, copy_missing=False, workers=None, buffer_size_mb=None,
+                 page_alignment_kb=None, temporary_folder=None, compression_policy=None):
+    workers = workers or os.cpu_count() or 1
+    compression_policy = compression_policy or CompressionPolicy()
+    buffer_size = (buffer_size_mb or ZIP_BUFFER_SIZE_MB) * 1024 * 1024
+    source_date_epoch = get_source_date_epoch()
+    # files added by protect-hybrid-js get the newest timestamp of the input, so the output does not depend on the clock
+    repack_date_time = max((info.date_time for info in index.name_to_info.values()), default=ZIP_MINIMUM_DATE_TIME)
+
+    files = {}
+    for folderName, subfolders, filenames in os.walk(out_dir):
+        for filename in filenames:
+            target_file = os.path.join(folderName, filename)
+            key = os.path.relpath(target_file, out_dir).replace(os.sep, '/')
+            files[index.get_original_name(key)] = target_file
+    file_names = [name for name, info in index.name_to_info.items()
+                  if name in files or copy_missing or info.filename.endswith("/")]
+    file_names.extend(sorted(name for name in files if index.get_info(name) is None))
+
+    with open(index.zip_file, 'rb') as source_fp:
+        zf = ZipRepackWriter(out_zip_file, buffer_size, None if page_alignment_kb is None else page_alignment_kb * 1024)
+
+        def prepare(target_file, source_info, compress_type, compress_level, extracted_stat, crc_executor):
+            start = time.perf_counter()
+            prepared = prepare_entry(target_file, source_info, compress_type, buffer_size, temporary_folder,
+                                     extracted_stat, crc_executor, compress_level)
+            return prepared, time.perf_counter() - start
+
+        def write_entry(info, source_info, target_file, rule, future):
+            prepared, seconds = (None, 0.0) if future is None else future.result()
+            if prepared is None:
+                zf.copy_raw(info, source_fp, source_info)
+                if not info.filename.endswith("/"):
+                    compression_policy.add_copied(source_info)
+                return
+            compress_type, crc, file_size, compress_size, spool = prepared
+            rule.entries += 1
+            rule.file_size += file_size
+            rule.compress_size += compress_size
+            rule.seconds += seconds
+            with (spool or open(target_file, "rb")) as stream:
+                zf.write_stream(info, compress_type, crc, file_size, compress_size, stream)
 
-    zf.close()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=workers) as crc_executor:
+                # entries are prepared in parallel and written in order, a few ahead of the writer
+                pending = collections.deque()
+                for file_in_zip in file_names:
+                    source_info = index.get_info(file_in_zip)
+                    if source_info is not None:
+                        info = copy_entry_info(source_info)
+                    else:
+                        info = zipfile.ZipInfo(file_in_zip, date_time=repack_date_time)
+                        info.create_system = 0
+                    if source_date_epoch is not None:
+                        info.date_time = source_date_epoch
+
+                    target_file = files.get(file_in_zip)
+                    rule = compression_policy.get_rule(file_in_zip)
+                    future = None
+                    if target_file is not None:
+                        future = executor.submit(prepare, target_file, source_info,
+                                                 rule.get_compression_type(index.get_compression_type(file_in_zip)),
+                                                 rule.level, index.extracted_stats.get(file_in_zip),
+                                                 crc_executor if workers > 1 else None)
+                    pending.append((info, source_info, target_file, rule, future))
+                    if len(pending) >= 2 * workers:
+                        write_entry(*pending.popleft())
+                while len(pending) > 0:
+                    write_entry(*pending.popleft())
+        finally:
+            zf.close(index.comment)
 
 
 def protect_apk(args, protect_hybrid_path, protect_hybrid_blueprint, apk, protect_android_blueprint, protect_android_path, native_protection,
                 tamper_action_type=None, tamper_action_method=None):
 
-    temporary_protect_hybrid_directory = tempfile.mkdtemp()
-    temporary_decoded_apk_directory = tempfile.mkdtemp()
-    temporary_apk_out_directory = os.path.join(temporary_protect_hybrid_directory, "out")  # Prevent copying exception later
-
     apk_fullpath = os.path.realpath(apk)
     apk_filename = file_without_extension(apk_fullpath)
     isAAB = apk_fullpath.endswith('.aab')
+    extract_patterns = get_selective_extraction_patterns(isAAB) if args.selective_extraction else None
+    temporary_protect_hybrid_directory = None
+    temporary_decoded_apk_directory = None
+
+    target_type = get_target_type(args)
+    sjs = None
 
     try:
+        try:
+            archive_index = ArchiveIndex(apk_fullpath)
+        except (OSError, zipfile.BadZipFile) as e:
+            raise ValueError('Unable to read "{}": {}'.format(apk_fullpath, e))
+        workspace = get_workspace_folder(args.workspace, archive_index.get_extracted_size(extract_patterns))
+
+        temporary_protect_hybrid_directory = make_temporary_folder(workspace)
+        temporary_decoded_apk_directory = make_temporary_folder(workspace)
+        temporary_apk_out_directory = os.path.join(temporary_protect_hybrid_directory, "out")  # Prevent copying exception later
+        # updated blueprints are private to this run and removed with the temporary directory
+        temporary_blueprint_directory = os.path.join(temporary_protect_hybrid_directory, "blueprints")
+        os.mkdir(temporary_blueprint_directory)
+
         updated_protect_android_blueprint = None
         protect_android_json = None
 
+        # Fail before the (possibly large) APK/AAB is extracted
+        print_section_start('Validating configuration')
+        problems = get_configuration_problems(protect_hybrid_blueprint, protect_android_blueprint, target_type, native_protection)
+        if len(problems) > 0:
+            raise ValueError("Found " + str(len(problems)) + " configuration problem(s):\n\t" + "\n\t".join(problems))
+        compression_policy = CompressionPolicy(args.compression_policy)
+        print("\tConfiguration is valid.")
+        print_section_end()
+
         if native_protection:
             # Blueprint for Digital.ai Android App Protection creation
             print_section_start('Loading & validating Digital.ai Android App Protection blueprint')
             if protect_android_blueprint is None:
-                updated_protect_android_blueprint = "protect-android.blueprint.default.updated"
+                updated_protect_android_blueprint = os.path.join(temporary_blueprint_directory, "protect-android.blueprint.default.updated")
                 protect_android_json = get_default_protect_android_blueprint_json(isAAB)
                 print("\tUsing default Digital.ai Android App Protection blueprint ('" + updated_protect_android_blueprint + "')")
             else:
-                updated_protect_android_blueprint = protect_android_blueprint + ".updated"
-                protect_android_json = load_json_from_file(protect_android_blueprint)
-                if "guardConfiguration" not in protect_android_json:
-                    raise ValueError("Provided Digital.ai Android App Protection blueprint does not contain " +
-                                     "'guardConfiguration' section.")
+                updated_protect_android_blueprint = os.path.join(temporary_blueprint_directory, os.path.basename(protect_android_blueprint) + ".updated")
+                # deep copy, guards are added to the loaded blueprint below
+                protect_android_json = copy.deepcopy(load_json_from_file(protect_android_blueprint))
                 print("\tDigital.ai Android App Protection blueprint (" + protect_android_blueprint + ") was loaded successfully.")
             print_section_end()
 
         # Expand APK
         print_section_start('Extracting')
-        compression_report, hash_map = decompress_with_report(apk_fullpath, temporary_decoded_apk_directory)
+        extract_entries(archive_index, temporary_decoded_apk_directory, extract_patterns, args.jobs,
+                        args.repack_buffer_size)
+        if len(archive_index.renamed_files) > 0:
+            print('\n{} entries with case insensitive name collisions were extracted under new names.'
+                  .format(len(archive_index.renamed_files)))
+            if args.renamed_files is not None:
+                archive_index.save_renamed_files(args.renamed_files)
+                print('The renamed entries are listed in "{}".'.format(args.renamed_files))
 
         if isAAB:
             print('\nDecoded AAB "{}" in the temporary directory "{}".'.format(apk_fullpath, temporary_decoded_apk_directory))
@@ -876,11 +2096,9 @@ def protect_apk(args, protect_hybrid_path, protect_hybrid_blueprint, apk, protec
         application_package_name = None
 
         if isAAB:
-            manifest_path = os.path.join(temporary_decoded_apk_directory, 'base/manifest/AndroidManifest.xml')
-            application_package_name = AndroidManifestParser(open(manifest_path, 'rb').read()).get_aab_package()
+            application_package_name = AndroidManifestParser(archive_index.read('base/manifest/AndroidManifest.xml')).get_aab_package()
         else:
-            manifest_path = os.path.join(temporary_decoded_apk_directory, 'AndroidManifest.xml')
-            application_package_name = AndroidManifestParser(open(manifest_path, 'rb').read()).get_apk_package()
+            application_package_name = AndroidManifestParser(archive_index.read('AndroidManifest.xml')).get_apk_package()
 
         if application_package_name == None:
             print('\nCould not retrieve the package name from extracted AndroidManifest.xml file.')
@@ -892,7 +2110,8 @@ def protect_apk(args, protect_hybrid_path, protect_hybrid_blueprint, apk, protec
         sjs = HybridJavaScriptProtection(protect_hybrid_path=protect_hybrid_path, application_package_name=application_package_name)
 
         if isAAB:
-            shutil.copytree(temporary_decoded_apk_directory, temporary_apk_out_directory)
+            # protect-hybrid-js writes base/ only, the other modules are never modified
+            clone_tree(temporary_decoded_apk_directory, temporary_apk_out_directory, ["*"], ["base/*"])
             sjs.input_folder = os.path.join(temporary_decoded_apk_directory, 'base')
             sjs.output_folder = os.path.join(temporary_apk_out_directory, 'base')
         else:
@@ -900,15 +2119,8 @@ def protect_apk(args, protect_hybrid_path, protect_hybrid_blueprint, apk, protec
             sjs.output_folder = temporary_apk_out_directory
 
         sjs.config_file_path = protect_hybrid_blueprint
-
-        if args.reactnative:
-            sjs.target_type = TargetType.REACT_NATIVE
-        if args.nativescript:
-            sjs.target_type = TargetType.NATIVESCRIPT
-        if args.cordova:
-            sjs.target_type = TargetType.CORDOVA
-        if args.ionic:
-            sjs.target_type = TargetType.IONIC
+        sjs.work_folder = temporary_blueprint_directory
+        sjs.target_type = target_type
 
         if sjs.protect() != 0:
             raise ValueError("Failed to apply protect-hybrid-js.")
@@ -930,10 +2142,14 @@ def protect_apk(args, protect_hybrid_path, protect_hybrid_blueprint, apk, protec
             repacked_apk_filename = apk_filename + '.protected.unsigned.aab'
         else:
             repacked_apk_filename = apk_filename + '.protected.unsigned.apk'
-        compress_dir(temporary_apk_out_directory, repacked_apk_filename, compression_report, hash_map)
+        compress_dir(temporary_apk_out_directory, repacked_apk_filename, archive_index,
+                     args.selective_extraction, args.jobs, args.repack_buffer_size,
+                     None if isAAB else args.page_alignment, temporary_protect_hybrid_directory, compression_policy)
         repacked_apk_path = os.path.realpath(repacked_apk_filename)
         print('\nRepacked the temporary directory "{}" as "{}".'
               .format(temporary_apk_out_directory, repacked_apk_path))
+        for line in compression_policy.get_report():
+            print('\t' + line)
         print_section_end()
 
         if native_protection:
@@ -969,14 +2185,21 @@ def protect_apk(args, protect_hybrid_path, protect_hybrid_blueprint, apk, protec
         print_section_end()
 
     finally:
-        if sjs.updated_config_file_path is not None and os.path.exists(sjs.updated_config_file_path):
+        if sjs is not None and sjs.updated_config_file_path is not None and os.path.exists(sjs.updated_config_file_path):
             os.remove(sjs.updated_config_file_path)
 
-        remove_dir(temporary_decoded_apk_directory)
-        remove_dir(temporary_protect_hybrid_directory)
         print_section_start('Cleaning')
-        print('Removed the temporary directory "{}".'.format(temporary_protect_hybrid_directory))
-        print('Removed the temporary directory "{}".'.format(temporary_decoded_apk_directory))
+        temporary_directories = [directory for directory in [temporary_decoded_apk_directory, temporary_protect_hybrid_directory]
+                                 if directory is not None]
+        if args.async_cleanup:
+            remove_dirs_in_background(temporary_directories)
+            for directory in reversed(temporary_directories):
+                print('Removing the temporary directory "{}" in the background.'.format(directory))
+        else:
+            for directory in temporary_directories:
+                remove_dir(directory)
+            for directory in reversed(temporary_directories):
+                print('Removed the temporary directory "{}".'.format(directory))
         print_section_end()
 
 class AndroidManifestParser:
@@ -1120,6 +2343,8 @@ def execute():
             tamper_action_type = "method"
 
     native_protection = not args.disable_native_protection
+    protect_hybrid_overlays = args.blueprint_overlay_for_hybrid or []
+    temporary_protect_hybrid_config = None
 
     # initial validation
 
@@ -1133,22 +2358,37 @@ def execute():
         validate_file_exists(args.apk)
         if protect_hybrid_config_path is not None:
             validate_file_exists(protect_hybrid_config_path)
+        if len(protect_hybrid_overlays) > 0:
+            if protect_hybrid_config_path is None:
+                raise ValueError("Blueprint overlays require the blueprint file for protect-hybrid-js (-b4h).")
+            for overlay in protect_hybrid_overlays:
+                validate_file_exists(overlay)
+            temporary_protect_hybrid_config = materialize_blueprint_overlays(protect_hybrid_config_path, protect_hybrid_overlays)
+            protect_hybrid_config_path = temporary_protect_hybrid_config
         if protect_android_config is not None:
             validate_file_exists(protect_android_config)
+        if args.compression_policy is not None:
+            validate_file_exists(args.compression_policy)
         protect_hybrid_path = validate_executable_path(protect_hybrid_path, "protect-hybrid-js", "Digital.ai Hybrid JavaScript Protection")
     except Exception as e:
+        if temporary_protect_hybrid_config is not None:
+            os.remove(temporary_protect_hybrid_config)
         raise SystemExit(e)
 
     # Extract / protect-hybrid-js / Archive / protect-android / Clean
-    protect_apk(args,
-                protect_hybrid_path,
-                protect_hybrid_config_path,
-                args.apk,
-                protect_android_config,
-                protect_android_path,
-                native_protection,
-                tamper_action_type,
-                tamper_action_method)
+    try:
+        protect_apk(args,
+                    protect_hybrid_path,
+                    protect_hybrid_config_path,
+                    args.apk,
+                    protect_android_config,
+                    protect_android_path,
+                    native_protection,
+                    tamper_action_type,
+                    tamper_action_method)
+    finally:
+        if temporary_protect_hybrid_config is not None:
+            os.remove(temporary_protect_hybrid_config)
 
     print('Digital.ai Hybrid JavaScript Protection (Android) - finish')
 
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import random
+import shutil
+import tempfile
+import time
+import tokenize
+
+
+SCRIPTS_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPTS = {
+    "android": "android/protect-hybrid-android.py",
+    "ios": "ios/protect-hybrid-ios.py",
+    "install-plugin": "codeLiftingDetection/hybrid-install-plugin.py",
+    "hermes": "reactnative/hermes/protect-hybrid-hermes-setup.py",
+    "codepush": "reactnative/codepush/protect-hybrid-codepush-setup.py",
+}
+
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 * 1024}
+
+# blueprints the tokenize based loader accepted or rejected in ways plain JSON with comments would not
+EDGE_CASES = [
+    b'{"a": 1} /**/',  # '**' operator, no comment
+    b'{"a": 1 /** doc */}',
+    b'{"a": 1 /* doc **/}',  # even run of '*' does not close
+    b'{"a": 1 /* doc ***/}',
+    b'{"a": 1 / * spaced * / }',
+    b'{"a": 1} /* unterminated',
+    b'{"a": 1 /* "*/" */}',  # quoted close
+    b'{"a": 1, /* [ */ "b": 2}',  # bracket left open in a comment
+    b'{"a": 1} // closing }',
+    b'{"a": "raw\nnewline"}',
+    b'{"a": t rue, "b": 1 2}',  # whitespace dropped between tokens
+    b'{"a": [1, 2,], /* c */ } // trailing commas',
+    b'{"a": 1,\n "b": 2 "c": 3}',
+    b'{"a": 1} # hash',
+    b"{\"a\": 1} // it's",
+    b'{"a": 1} // """',
+    b'{"a": 1} // C:\\temp\\\n',  # backslash ending a line
+    b'\n{"a": 1}',  # blank first line
+    b'  {"a": 1},',  # indented first line keeps the last comma
+    b'\xef\xbb\xbf{"a": 1,}',
+]
+
+
+# # # ARGUMENTS # # #
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(
+        description='Compare blueprint loading time of the wrapper scripts against the tokenize based loader.')
+    parser.add_argument("-s", "--size", metavar="<SIZE>", default="1M",
+                        help="Size of the generated blueprint, K and M suffixes allowed (default: 1M).")
+    parser.add_argument("-r", "--repeat", metavar="<COUNT>", type=int, default=3,
+                        help="Number of timed runs per loader; the best run is reported (default: 3).")
+    return parser.parse_args()
+
+
+def parse_size(size):
+    size = size.strip().upper().rstrip("B")
+    if size[-1:] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+# # # Legacy tokenize based loader (reference) # # #
+SKIP_TOKEN_TYPES = [tokenize.ENCODING, tokenize.NL, tokenize.NEWLINE, tokenize.ENDMARKER]
+
+def get_ignored_tokens_count(tokens, current_idx):
+    max_idx = len(tokens)
+    if current_idx >= max_idx:
+        return 0
+    token = tokens[current_idx]
+
+    if token.type == tokenize.OP:
+        # single line comment skip
+        if token.string == '//':
+            for idx in range(current_idx + 1, max_idx):
+                token = tokens[idx]
+                if token.type == tokenize.NL or token.type == tokenize.NEWLINE:
+                    return idx - current_idx
+            return 0
+
+        # multiline comment skip
+        if token.string == '/' and (current_idx < max_idx - 1) and tokens[current_idx + 1].string == '*':
+            for idx in range(current_idx + 1, max_idx - 1):
+                token = tokens[idx]
+                if token.string == '*' and tokens[idx + 1].string == '/':
+                    return 2 + idx - current_idx
+            return 0
+    elif token.type in SKIP_TOKEN_TYPES:
+        return 1
+    return 0
+
+def is_trailing_comma(tokens, current_idx):
+    token = tokens[current_idx]
+    max_idx = len(tokens)
+    return (token.type == tokenize.OP and
+            token.string == ',' and
+            ( current_idx + 1 == max_idx or tokens[current_idx + 1].string == "}" or tokens[current_idx + 1].string == "]"))
+
+def remove_comments_and_newlines(tokens):
+    output = []
+    max_idx = len(tokens)
+    idx = 0
+    while idx < max_idx:
+        count = get_ignored_tokens_count(tokens, idx)
+        if (count):
+            idx += count
+        else:
+            output.append(tokens[idx])
+            idx += 1
+    return output
+
+def remove_trailing_commas(tokens):
+    output = []
+    for i in range(0, len(tokens)):
+        if (not is_trailing_comma(tokens, i)):
+            output.append(tokens[i])
+    return output
+
+def legacy_load_json_from_file(file_name):
+    output_string = ""
+    with open(file_name, 'rb') as json_file:
+        tokens = list(tokenize.tokenize(json_file.read))
+        tokens = remove_comments_and_newlines(tokens)
+        tokens = remove_trailing_commas(tokens)
+        for i in range(0, len(tokens)):
+            output_string += tokens[i].string
+    if len(output_string.strip()) == 0:
+        raise ValueError("Provided blueprint file '" + file_name +
+                         "' is empty. Make sure the file is a non-empty JSON.")
+    return json.loads(output_string.strip())
+
+
+# # # Blueprint generation # # #
+
+def get_guard_configuration(rnd, idx):
+    # mirrors sample.blueprint: about a third of the lines are comments or commented-out settings
+    return [
+        '        "guard_configuration_{}": {{'.format(idx),
+        '            "protectionPreset": "{}",'.format(rnd.choice(["normal", "optimized", "maximum"])),
+        '            "identifierRenaming": {',
+        '                "enable": {},'.format("true" if rnd.random() < 0.8 else "false"),
+        '                "scheme": "short",',
+        '                "ignore": ["ignored{}"],'.format(idx),
+        '//              "modifier": {',
+        '//                  "positions": ["prefix", "postfix", "infix"],',
+        '//                  "scope": "global" // "all"',
+        '//              }',
+        '            },',
+        '            /* string encryption tuned per module */',
+        '            "stringEncryption": {',
+        '                "enable": true,',
+        '                "protectionCoverage": {},'.format(rnd.randint(10, 100)),
+        '                "maxLength": 64, // longer strings are left as is',
+        '            },',
+        '            "codeLiftingDetection": [',
+        '                {',
+        '                    "name": "CLD Auto Instance {}",'.format(idx),
+        '                    "enable": false,',
+        '                    "invocationLocations": "auto"',
+        '                },',
+        '//              {',
+        '//                  "name": "CLD Function Invoked Instance",',
+        '//                  "invocationLocations": ["invocationFromFunction"]',
+        '//              }',
+        '            ],',
+        '            "functions": ["module{}.*", "vendor{}.init"],'.format(idx, idx),
+        '        },',
+    ]
+
+
+def generate_blueprint(file_name, size):
+    """Generates a blueprint of about `size` bytes; guard configurations and ignorePaths grow together.
+    Returns the number of guard configurations and ignorePaths."""
+    rnd = random.Random(size)
+    head = ['{',
+            '    // Generated by blueprint-benchmark.py',
+            '    "globalConfiguration": {',
+            '        "seed": "random",',
+            '        "targetType": "reactnative-android",',
+            '        /* "appID": "com.example.app", */',
+            '    },',
+            '    "guardConfigurations": {']
+    middle = ['    },',
+              '    "targets": {',
+              '        "main": {',
+              '            "guardConfiguration": "guard_configuration_0",',
+              '            "ignorePaths": [']
+    tail = ['            ],',
+            '        },',
+            '    },',
+            '}']
+    guard_lines = []
+    path_lines = []
+    length = sum(len(line) + 1 for line in head + middle + tail)
+    guard_configurations = 0
+    ignore_paths = 0
+    while length < size or guard_configurations == 0:
+        lines = get_guard_configuration(rnd, guard_configurations)
+        guard_lines.extend(lines)
+        length += sum(len(line) + 1 for line in lines)
+        guard_configurations += 1
+        # ten ignored paths per guard configuration, every fifth one commented out
+        for _ in range(10):
+            if length >= size and ignore_paths > 0:
+                break
+            line = '                "assets/vendor/module{}/index.js", // vendored'.format(ignore_paths)
+            if ignore_paths % 5 == 4:
+                line = '//              "assets/vendor/module{}/index.js",'.format(ignore_paths)
+            path_lines.append(line)
+            length += len(line) + 1
+            ignore_paths += 1
+    with open(file_name, 'w') as file:
+        file.write("\n".join(head + guard_lines + middle + path_lines + tail))
+    return guard_configurations, ignore_paths
+
+
+# # # Utils # # #
+
+def load_script(name, relative_path):
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(SCRIPTS_FOLDER, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_loader(name, module):
+    if hasattr(module, "parse_json_from_file"):  # bypass the per-process blueprint memo
+        return module.parse_json_from_file
+    if hasattr(module, "load_json_from_file"):
+        return module.load_json_from_file
+    return module.Blueprint().load_hybrid_blueprint
+
+
+def get_outcome(function, file_name):
+    """Returns (True, blueprint) or (False, error message) of loading `file_name` with `function`."""
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            return True, function(file_name)
+    except SystemExit:  # ERROR() of the setup scripts
+        return False, output.getvalue().strip()
+    except Exception as e:
+        return False, str(e)
+
+
+def count_legacy_matches(function, edge_cases):
+    """Returns the number of edge case blueprints `function` loads, or fails on, as the tokenize based loader did."""
+    matches = 0
+    for file_name in edge_cases:
+        legacy_loaded, legacy_result = get_outcome(legacy_load_json_from_file, file_name)
+        loaded, result = get_outcome(function, file_name)
+        if loaded == legacy_loaded and (result == legacy_result if loaded else result.endswith(legacy_result)):
+            matches += 1
+    return matches
+
+
+def best_of(repeat, function, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+# # # MAIN # # #
+
+def execute():
+    args = parse_cli_args()
+    # measure the loaders themselves, not the on-disk blueprint cache
+    os.environ.pop('PROTECT_HYBRID_BLUEPRINT_CACHE', None)
+
+    temporary_folder = tempfile.mkdtemp()
+    blueprint = os.path.join(temporary_folder, "benchmark.blueprint")
+    edge_cases = []
+    try:
+        for idx, content in enumerate(EDGE_CASES):
+            edge_cases.append(os.path.join(temporary_folder, "edge{}.blueprint".format(idx)))
+            with open(edge_cases[-1], 'wb') as file:
+                file.write(content)
+        guard_configurations, ignore_paths = generate_blueprint(blueprint, parse_size(args.size))
+        print("Blueprint: {} bytes, {} guard configurations, {} ignorePaths"
+              .format(os.path.getsize(blueprint), guard_configurations, ignore_paths))
+
+        legacy_time, expected = best_of(args.repeat, legacy_load_json_from_file, blueprint)
+        print("{:<16} {:>10.4f}s".format("tokenize", legacy_time))
+
+        for name, relative_path in SCRIPTS.items():
+            loader = get_loader(name, load_script(name, relative_path))
+            elapsed, result = best_of(args.repeat, loader, blueprint)
+            status = "OK" if result == expected else "MISMATCH"
+            matches = count_legacy_matches(loader, edge_cases)
+            print("{:<16} {:>10.4f}s  x{:<8.1f} {:<9} edge cases {}/{}".format(
+                name, elapsed, legacy_time / elapsed, status, matches, len(edge_cases)))
+    finally:
+        shutil.rmtree(temporary_folder)
+
+
+if __name__ == "__main__":
+    execute()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import importlib.util
+import json
+import platform
+import sys
+import tempfile
+
+
+# scripts, loading, timing and blueprint generation are shared with blueprint-benchmark.py
+BENCHMARK_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "blueprint-benchmark.py")
+
+PHASES = ["strip", "parse", "lookup", "rewrite"]
+
+
+# # # ARGUMENTS # # #
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(
+        description='Measure blueprint strip, parse, lookup and rewrite time of the wrapper scripts for growing blueprints.')
+    parser.add_argument("-s", "--sizes", metavar="<SIZES>", default="1K,10K,100K,1M,10M",
+                        help="Comma separated blueprint sizes, K and M suffixes allowed (default: 1K,10K,100K,1M,10M).")
+    parser.add_argument("-r", "--repeat", metavar="<COUNT>", type=int, default=3,
+                        help="Number of timed runs per phase; the best run is reported (default: 3).")
+    parser.add_argument("-o", "--output", metavar="<PATH>",
+                        help="Path to the JSON results file (default: blueprint-suite.json).",
+                        default="blueprint-suite.json")
+    parser.add_argument("-c", "--compare", metavar="<PATH>",
+                        help="Path to a JSON results file of a previous run to compare with.")
+    return parser.parse_args()
+
+
+# # # Utils # # #
+
+def load_benchmark():
+    spec = importlib.util.spec_from_file_location("blueprint_benchmark", BENCHMARK_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_phases(module, blueprint, work_folder):
+    """Returns phase name -> callable for the blueprint helpers the script has."""
+    if hasattr(module, "Blueprint"):
+        helper = module.Blueprint()
+        strip = helper.get_json_as_string
+        parse = helper.load_hybrid_blueprint
+        get_insensitive = helper.get_insensitive
+    else:
+        strip = module.get_json_as_string
+        # bypass the per-process blueprint memo
+        parse = getattr(module, "parse_json_from_file", module.load_json_from_file)
+        get_insensitive = module.get_insensitive
+    document = parse(blueprint)
+
+    def lookup():
+        guard_configs = get_insensitive(document, "GuardConfigurations")
+        for name in guard_configs:
+            guard_config = get_insensitive(guard_configs, name.upper())
+            get_insensitive(guard_config, "protectionpreset")
+            get_insensitive(guard_config, "codeLiftingDetection")
+            get_insensitive(guard_config, "missingGuard")
+        return get_insensitive(get_insensitive(document, "globalConfiguration"), "TARGETTYPE")
+
+    phases = {
+        "strip": lambda: strip(blueprint),
+        "parse": lambda: parse(blueprint),
+        "lookup": lookup,
+    }
+    if hasattr(module, "HybridJavaScriptProtection"):
+        def rewrite():
+            try:
+                protection = module.HybridJavaScriptProtection("protect-hybrid-js", None)
+            except TypeError:
+                protection = module.HybridJavaScriptProtection("protect-hybrid-js")
+            protection.config_file_path = blueprint
+            protection.input_folder = work_folder
+            protection.work_folder = work_folder
+            protection.update_relative_ignorepaths()
+            if protection.updated_config_file_path is not None:
+                os.remove(protection.updated_config_file_path)
+        phases["rewrite"] = rewrite
+    return phases
+
+
+def load_previous_results(file_name):
+    with open(file_name, 'r') as results_file:
+        previous = json.load(results_file)
+    return {(result["script"], result["size"], result["phase"]): result["seconds"] for result in previous["results"]}
+
+
+# # # MAIN # # #
+
+def execute():
+    args = parse_cli_args()
+    # measure the loaders themselves, not the on-disk blueprint cache
+    os.environ.pop('PROTECT_HYBRID_BLUEPRINT_CACHE', None)
+
+    previous = load_previous_results(args.compare) if args.compare else {}
+    benchmark = load_benchmark()
+    modules = {name: benchmark.load_script(name, relative_path) for name, relative_path in benchmark.SCRIPTS.items()}
+    results = []
+
+    temporary_folder = tempfile.mkdtemp()
+    blueprint = os.path.join(temporary_folder, "benchmark.blueprint")
+    try:
+        for size in [benchmark.parse_size(size) for size in args.sizes.split(",")]:
+            guard_configurations, ignore_paths = benchmark.generate_blueprint(blueprint, size)
+            blueprint_bytes = os.path.getsize(blueprint)
+            print("Blueprint: {} bytes, {} guard configurations, {} ignorePaths"
+                  .format(blueprint_bytes, guard_configurations, ignore_paths))
+            for name, module in modules.items():
+                phases = get_phases(module, blueprint, temporary_folder)
+                for phase in PHASES:
+                    if phase not in phases:
+                        continue
+                    elapsed, _ = benchmark.best_of(args.repeat, phases[phase])
+                    results.append({"script": name, "size": size, "bytes": blueprint_bytes,
+                                    "guardConfigurations": guard_configurations, "ignorePaths": ignore_paths,
+                                    "phase": phase, "seconds": elapsed})
+                    line = "{:<16} {:<8} {:>10.4f}s".format(name, phase, elapsed)
+                    previous_elapsed = previous.get((name, size, phase))
+                    if previous_elapsed:
+                        line += "  x{:<6.2f} vs previous".format(previous_elapsed / elapsed if elapsed else 0)
+                    print(line)
+    finally:
+        if os.path.exists(blueprint):
+            os.remove(blueprint)
+        os.rmdir(temporary_folder)
+
+    with open(args.output, 'w') as results_file:
+        json.dump({"python": platform.python_version(), "platform": sys.platform, "repeat": args.repeat,
+                   "results": results}, results_file, indent=2)
+    print("Results written to " + args.output)
+
+
+if __name__ == "__main__":
+    execute()
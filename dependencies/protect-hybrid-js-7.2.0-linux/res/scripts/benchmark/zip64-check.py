@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import importlib.util
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+
+SCRIPTS_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ANDROID_SCRIPT = "android/protect-hybrid-android.py"
+
+# just past the limits of the classic zip format
+ENTRIES_COUNT = zipfile.ZIP_FILECOUNT_LIMIT + 1000
+LARGE_ENTRY_SIZE = 0xFFFFFFFF + 16 * 1024 * 1024
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+# # # ARGUMENTS # # #
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(
+        description='Check extraction, indexing and repacking of the Android wrapper past the Zip64 thresholds.')
+    parser.add_argument("-l", "--large",
+                        help="Flag to also check entries and offsets over 4 GiB (needs about 17 GB of free disk space).",
+                        action='store_true')
+    parser.add_argument("-w", "--work-folder", metavar="<PATH>",
+                        help="Folder for the generated archives (default: temporary folder).")
+    return parser.parse_args()
+
+
+# # # Utils # # #
+
+def load_android_script():
+    spec = importlib.util.spec_from_file_location("protect_hybrid_android", os.path.join(SCRIPTS_FOLDER, ANDROID_SCRIPT))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_zeros(stream, size):
+    chunk = bytes(min(CHUNK_SIZE, size))
+    remaining = size
+    while remaining > 0:
+        stream.write(chunk[:min(len(chunk), remaining)])
+        remaining -= min(len(chunk), remaining)
+
+
+def generate_many_entries_archive(file_name):
+    with zipfile.ZipFile(file_name, 'w') as zf:
+        zf.writestr('AndroidManifest.xml', b'\x03\x00manifest')
+        zf.writestr('assets/index.android.bundle', b'var bundle = 1;\n' * 1000, compress_type=zipfile.ZIP_DEFLATED)
+        for idx in range(ENTRIES_COUNT):
+            compress_type = zipfile.ZIP_DEFLATED if idx % 2 else zipfile.ZIP_STORED
+            zf.writestr('res/raw/r{}.txt'.format(idx), 'resource {}\n'.format(idx) * 4, compress_type=compress_type)
+
+
+def generate_large_entry_archive(file_name):
+    with zipfile.ZipFile(file_name, 'w') as zf:
+        zf.writestr('AndroidManifest.xml', b'\x03\x00manifest')
+        with zf.open(zipfile.ZipInfo('assets/large.obb'), 'w', force_zip64=True) as stream:
+            write_zeros(stream, LARGE_ENTRY_SIZE)
+        # local header past 4 GiB
+        zf.writestr('assets/index.android.bundle', b'var bundle = 1;\n' * 1000, compress_type=zipfile.ZIP_DEFLATED)
+
+
+def verify(source_file, output_file, changed, resized=()):
+    """Returns the list of problems of the repacked archive compared to the source archive."""
+    problems = []
+    with zipfile.ZipFile(source_file) as source_zf, zipfile.ZipFile(output_file) as output_zf:
+        source_infos = source_zf.infolist()
+        output_infos = output_zf.infolist()
+        if [info.filename for info in source_infos] != [info.filename for info in output_infos]:
+            problems.append("entry names or order differ")
+        for source_info, output_info in zip(source_infos, output_infos):
+            if source_info.filename in changed:
+                if output_zf.read(output_info) != changed[source_info.filename]:
+                    problems.append('"{}" does not contain the changed data'.format(source_info.filename))
+            elif source_info.filename not in resized and (source_info.CRC, source_info.file_size) != (output_info.CRC, output_info.file_size):
+                problems.append('"{}" CRC or size differs'.format(source_info.filename))
+        bad_entry = output_zf.testzip()
+        if bad_entry is not None:
+            problems.append('"{}" fails the CRC check'.format(bad_entry))
+    return problems
+
+
+def check(android, name, source_file, work_folder, selective, changed, large_files=None):
+    print("{}:".format(name))
+    extracted_folder = os.path.join(work_folder, name + "-extracted")
+    output_file = os.path.join(work_folder, name + "-repacked.apk")
+    os.mkdir(extracted_folder)
+    try:
+        start = time.perf_counter()
+        index = android.ArchiveIndex(source_file)
+        patterns = android.get_selective_extraction_patterns(False) if selective else None
+        android.extract_entries(index, extracted_folder, patterns)
+        print("\tindexed and extracted {} entries in {:.1f}s".format(len(index.name_to_info), time.perf_counter() - start))
+
+        for entry_name, data in changed.items():
+            with open(os.path.join(extracted_folder, entry_name), 'wb') as changed_file:
+                changed_file.write(data)
+        for entry_name, size in (large_files or {}).items():
+            # sparse file of zeros, compressed again when repacking
+            with open(os.path.join(extracted_folder, entry_name), 'wb') as large_file:
+                large_file.truncate(size)
+
+        start = time.perf_counter()
+        android.compress_dir(extracted_folder, output_file, index, selective, page_alignment_kb=16)
+        print("\trepacked in {:.1f}s, {} bytes".format(time.perf_counter() - start, os.path.getsize(output_file)))
+
+        problems = verify(source_file, output_file, changed, large_files or ())
+        with zipfile.ZipFile(output_file) as output_zf:
+            for entry_name, size in (large_files or {}).items():
+                if output_zf.getinfo(entry_name).file_size != size:
+                    problems.append('"{}" has a wrong size'.format(entry_name))
+        for problem in problems:
+            print("\t[X] " + problem)
+        print("\t" + ("FAIL" if problems else "PASS"))
+        return len(problems) == 0
+    finally:
+        shutil.rmtree(extracted_folder)
+        if os.path.exists(output_file):
+            os.remove(output_file)
+
+
+# # # MAIN # # #
+
+def execute():
+    args = parse_cli_args()
+    android = load_android_script()
+    work_folder = tempfile.mkdtemp(dir=args.work_folder)
+    changed = {'assets/index.android.bundle': b'var protected = 1;\n' * 1000}
+    passed = True
+    try:
+        source_file = os.path.join(work_folder, "entries.apk")
+        generate_many_entries_archive(source_file)
+        passed &= check(android, "entries", source_file, work_folder, False, changed)
+        os.remove(source_file)
+
+        if args.large:
+            source_file = os.path.join(work_folder, "large.apk")
+            generate_large_entry_archive(source_file)
+            # large entry copied raw, changed bundle written past 4 GiB
+            passed &= check(android, "large-raw", source_file, work_folder, True, changed)
+            # large entry compressed again
+            passed &= check(android, "large-compressed", source_file, work_folder, False, changed,
+                            {'assets/large.obb': LARGE_ENTRY_SIZE + 1})
+            os.remove(source_file)
+    finally:
+        shutil.rmtree(work_folder)
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    execute()
@@ -12,7 +12,6 @@ from pathlib import Path
 import shutil
 
 import json
-import tokenize
 
 
 def ERROR(msg):
@@ -34,78 +33,92 @@ class PlatformType:
 
 class Blueprint:
     def __init__(self):
-        self.SKIP_TOKEN_TYPES = [tokenize.ENCODING, tokenize.NL, tokenize.NEWLINE, tokenize.ENDMARKER]
-
-    def get_ignored_tokens_count(self, tokens, current_idx):
-        max_idx = len(tokens)
-        if current_idx >= max_idx:
-            return 0
-        token = tokens[current_idx]
-
-        if token.type == tokenize.OP:
-            # single line comment skip
-            if token.string == '//':
-                for idx in range(current_idx + 1, max_idx):
-                    token = tokens[idx]
-                    if token.type == tokenize.NL or token.type == tokenize.NEWLINE:
-                        return idx - current_idx
-                return 0
-
-            # multiline comment skip
-            if token.string == '/' and (current_idx < max_idx - 1) and tokens[current_idx + 1].string == '*':
-                for idx in range(current_idx + 1, max_idx - 1):
-                    token = tokens[idx]
-                    if token.string == '*' and tokens[idx + 1].string == '/':
-                        return 2 + idx - current_idx
-                return 0
-
-        elif token.type in self.SKIP_TOKEN_TYPES:
-            return 1
-
-        return 0
-
-    def is_trailing_comma(self, tokens, current_idx):
-        token = tokens[current_idx]
-        max_idx = len(tokens)
-        return (token.type == tokenize.OP and
-                token.string == ',' and 
-                (current_idx + 1 == max_idx or tokens[current_idx + 1].string == "}" or tokens[current_idx + 1].string == "]"))
-
-    def remove_comments_and_newlines(self, tokens):
-        output = []
-        max_idx = len(tokens)
-        idx = 0
-        while idx < max_idx:
-            count = self.get_ignored_tokens_count(tokens, idx)
-            if (count):
-                idx += count
+        # Single pass over the raw bytes: findall() returns only the kept group, so whitespace, comments and
+        # trailing commas (followed only by whitespace/comments and '}', ']' or end of file) are dropped.
+        # Comments are recognized as the previous tokenize based loader did: '//' and '/*' not followed by '*' or
+        # '=', closed by an odd run of '*' and a '/' not followed by '/' or '=' ('**' and '//' were operators,
+        # spaces between '/' and '*' were ignored), skipping quoted strings and '#' comments in between.
+        # Strings (but triple quoted ones) end on their line, a lone quote is kept as is.
+        json_string = rb'"[^"\\\r\n]*(?:\\.[^"\\\r\n]*)*"'
+        triple_quoted = rb'"""(?:[^"\\]|\\[\s\S]|"(?!""))*"""|' + rb"""'''(?:[^'\\]|\\[\s\S]|'(?!''))*'''"""
+        lone_quote = rb"""(?:"(?![^"\\\r\n]*(?:\\.[^"\\\r\n]*)*")|'(?![^'\\\r\n]*(?:\\.[^'\\\r\n]*)*'))"""
+        quoted = (triple_quoted + rb'|' + json_string +
+                  rb"""|'[^'\\\r\n]*(?:\\.[^'\\\r\n]*)*'|#[^\r\n]*(?![^\r\n])|""" + lone_quote)
+        no_token = rb'(?:' + lone_quote + rb'|[\\$?`]|!(?!=))'
+        comment = (rb'//(?!=)[^\r\n]*(?![^\r\n])'
+                   rb'|/(?=[ \t\f]*\*(?![*=]))(?:' + quoted + rb"""|[^"'#*]"""  # never past its end
+                   rb'|(?:\*\*)+(?!\*)|\*(?:\*\*)*(?![*=]|[ \t\f]*/(?![/=])))*'
+                   rb'(?:\*\*)*\*[ \t\f]*/(?![/=])')
+        # Single quoted strings, '#' comments and triple quoted strings were kept with their spaces, as were the
+        # spaces before a lone quote or a character starting no token. An indented first line made the tokenize
+        # based loader end with a DEDENT token, so the last comma was kept.
+        self.JSONC_STRIP_PATTERNS = {}
+        for tokenize_quirks in (False, True):
+            if tokenize_quirks:
+                kept = quoted + rb"""|[^\s"'#/,]+|[ \t\f]+(?=""" + no_token + rb')'
+                dropped = rb'\s+(?!\s|' + no_token + rb')|\s*[\r\n\v]'
             else:
-                output.append(tokens[idx])
-                idx += 1
-        return output
-
-    def remove_trailing_commas(self, tokens):
-        output = []
-        for i in range(0, len(tokens)):
-            if not self.is_trailing_comma(tokens, i):
-                output.append(tokens[i])
-        return output
+                kept = json_string + rb'|[^\s"/,]+|"'
+                dropped = rb'\s+'
+            for indented in (False, True):
+                end_of_file = rb'' if indented else rb'|\Z'
+                self.JSONC_STRIP_PATTERNS[tokenize_quirks, indented] = re.compile(
+                    dropped + rb'|' + comment +  # whitespace and comments
+                    rb'|((?:' + kept +  # kept: strings and plain JSON...
+                    rb'|,(?!\s*(?:(?:' + comment + rb')\s*)*(?:[}\]]' + end_of_file + rb')))+'  # ...non-trailing commas
+                    rb'|/)'  # ...and slashes starting no comment
+                    rb'|,')  # trailing comma
+        single_quoted = json_string + rb"""|'[^'\\\r\n]*(?:\\.[^'\\\r\n]*)*'|#[^\r\n]*"""
+        self.JSONC_QUOTED_PATTERN = re.compile(triple_quoted + rb'|' + single_quoted)
+        self.JSONC_UNTERMINATED_PATTERN = re.compile(
+            triple_quoted + rb'''|("""|\'\'\'|"[^"\\\r\n]*(?:\\[^\r\n][^"\\\r\n]*)*\\\r?\n'''
+            rb"""|'[^'\\\r\n]*(?:\\[^\r\n][^'\\\r\n]*)*\\\r?\n)|""" + single_quoted)
+        self.JSONC_NO_TOKEN_PATTERN = re.compile(rb"""["'\\$?`!]""")
+        # The tokenize based loader read the whole file as a single line: a blank first line made all of it blank
+        # and a '#' at its start made all of it a comment.
+        self.JSONC_LEADING_PATTERN = re.compile(rb'(?:\xef\xbb\xbf)?([ \t\f]*)([\r\n#]?)')
+
+    def get_bracket_depth(self, data):
+        return (data.count(b'{') + data.count(b'[') + data.count(b'(') -
+                data.count(b'}') - data.count(b']') - data.count(b')'))
+
+    # The tokenize based loader failed before the JSON was parsed on a triple quoted string left open or a string
+    # continued by a backslash ending its line and, outside strings (code), comments included, on brackets left
+    # open (or closed once too often) and on a backslash ending a line.
+    def get_tokenize_error(self, buffer, code):
+        if b'"""' in buffer or b"'''" in buffer or b'\\\n' in buffer or b'\\\r\n' in buffer:
+            for match in self.JSONC_UNTERMINATED_PATTERN.finditer(buffer):
+                if match.group(1) is not None:
+                    column = len(buffer[:match.start(1)].decode('utf-8-sig', 'replace'))
+                    return "('EOF in multi-line string', (1, " + str(column) + "))"
+        if self.get_bracket_depth(code) != 0 or b'\\\n' in code or b'\\\r\n' in code:
+            return "('EOF in multi-line statement', (2, 0))"
+        return None
 
     def get_json_as_string(self, file_name):
-        output_string = ""
         if not os.path.isfile(file_name):
             ERROR("Unable to locate protect-hybrid-js blueprint at " + file_name +
                   ". Make sure the path is correct and the file exists.")
         with open(file_name, 'rb') as json_file:
-            try:
-                tokens = list(tokenize.tokenize(json_file.read))
-            except Exception as e:
-                ERROR("Provided blueprint file '" + file_name + "' contains invalid JSON. " + str(e))
-            tokens = self.remove_comments_and_newlines(tokens)
-            tokens = self.remove_trailing_commas(tokens)
-            for i in range(0, len(tokens)):
-                output_string += tokens[i].string
-        return output_string.strip()
+            buffer = json_file.read()
+        leading = self.JSONC_LEADING_PATTERN.match(buffer)
+        if leading.group(2) == b'#':
+            json_bytes = buffer[leading.start(2):]
+        elif leading.group(2):
+            json_bytes = b''
+        else:
+            code = self.JSONC_QUOTED_PATTERN.sub(b' ', buffer)
+            tokenize_error = self.get_tokenize_error(buffer, code)
+            if tokenize_error is not None:
+                ERROR("Provided blueprint file '" + file_name + "' contains invalid JSON. " + tokenize_error)
+            tokenize_quirks = (self.JSONC_NO_TOKEN_PATTERN.search(code) is not None or
+                               b"'" in buffer or b'#' in buffer or b'"""' in buffer)
+            indented = leading.group(1).endswith((b' ', b'\t')) and leading.end() < len(buffer)
+            json_bytes = b''.join(self.JSONC_STRIP_PATTERNS[tokenize_quirks, indented].findall(buffer))
+        try:
+            return json_bytes.decode('utf-8-sig').strip()
+        except Exception as e:
+            ERROR("Provided blueprint file '" + file_name + "' contains invalid JSON. " + str(e))
 
     def load_hybrid_blueprint(self, file_name):
         json_str = self.get_json_as_string(file_name)
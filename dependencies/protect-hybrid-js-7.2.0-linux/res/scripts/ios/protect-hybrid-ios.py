@@ -2,14 +2,21 @@
 
 import os
 import argparse
+import ctypes
 import subprocess
 import shutil
 import tempfile
 import fnmatch
+import hashlib
 import sys
 import zipfile
 import json
-import tokenize
+import re
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 
 class TargetType:
@@ -32,6 +39,9 @@ def parse_cli_args():
                         help="Path to *.ipa file.")
     parser.add_argument("-b4h", "--blueprint-for-hybrid", metavar='<PATH>',
                         help="Path to the blueprint file for protect-hybrid-js.")
+    parser.add_argument("-b4ho", "--blueprint-overlay-for-hybrid", metavar='<PATH>', action='append',
+                        help="Path to a blueprint overlay deep-merged over the blueprint for protect-hybrid-js. "
+                             "Can be repeated, later overlays take precedence.")
     parser.add_argument("-b4a", "--blueprint-for-apple", metavar='<PATH>',
                         help="Path to the blueprint file for protect-apple.")
     target_type_group = parser.add_mutually_exclusive_group(required=False)
@@ -55,6 +65,12 @@ def parse_cli_args():
     parser.add_argument("-dnp", "--disable-native-protection",
                         help="Flag to disable protection using Digital.ai Apple Native Protection.",
                         action='store_true')
+    parser.add_argument("-ws", "--workspace", metavar='<PATH>',
+                        help="Folder for the temporary files, 'ram' for a RAM-backed folder (/dev/shm, /Volumes/RAMDisk). "
+                             "The default temporary folder is used if the app does not fit (default: temporary folder).")
+    parser.add_argument("-ac", "--async-cleanup",
+                        help="Flag to remove temporary files in a background process after the script finishes.",
+                        action='store_true')
 
     return parser.parse_args()
 
@@ -69,6 +85,7 @@ class HybridJavaScriptProtection:
         self.updated_config_file_path = None
         self.input_folder = None
         self.output_folder = None
+        self.work_folder = None
         self.target_type = TargetType.DEFAULT
 
     def protect(self):
@@ -86,26 +103,29 @@ class HybridJavaScriptProtection:
             paths_updated = False
 
             if targets:
+                target_paths = {}
                 for target in targets:
                     old_paths = get_insensitive(targets[target], 'ignorePaths')
                     if old_paths:
-                        updated_paths = []
-                        for path in old_paths:
-                            if os.path.exists(path):
-                                updated_path = path
-                            else:
-                                realpath = os.path.realpath(self.input_folder)
-                                updated_path = os.path.join(realpath, path.strip("/"))
-                            updated_paths.append(updated_path)
-                        set_insensitive(targets[target], 'ignorePaths',  updated_paths)
-
-                        paths_updated = True
+                        target_paths[target] = old_paths
+                # all targets are resolved in one batch, shared paths are checked once
+                resolved_paths = resolve_ignore_paths(
+                    [path for old_paths in target_paths.values() for path in old_paths], self.input_folder)
+                for target, old_paths in target_paths.items():
+                    set_insensitive(targets[target], 'ignorePaths', [resolved_paths[path] for path in old_paths])
+                    paths_updated = True
 
                 if paths_updated:
-                    self.updated_config_file_path = self.config_file_path + ".updated"
+                    self.updated_config_file_path = self.get_updated_config_file_path()
                     with open(self.updated_config_file_path, 'w') as output_json_file:
                         json.dump(protect_hybrid_json, output_json_file, indent=2)
 
+    def get_updated_config_file_path(self):
+        # inside the job's own folder, concurrent runs sharing a blueprint do not overwrite each other
+        if self.work_folder:
+            return os.path.join(self.work_folder, os.path.basename(self.config_file_path) + ".updated")
+        return self.config_file_path + ".updated"
+
     def create_protect_hybrid_arguments(self):
         protect_hybrid_args = []
 
@@ -131,92 +151,273 @@ class HybridJavaScriptProtection:
 
         return protect_hybrid_args
 
-# # # Json load with comments removal # # #
-SKIP_TOKEN_TYPES = [tokenize.ENCODING, tokenize.NL, tokenize.NEWLINE, tokenize.ENDMARKER]
-
-def get_ignored_tokens_count(tokens, current_idx):
-    max_idx = len(tokens)
-    if current_idx >= max_idx:
-        return 0
-    token = tokens[current_idx]
-
-    if token.type == tokenize.OP:
-        # single line comment skip
-        if token.string == '//':
-            for idx in range(current_idx + 1, max_idx):
-                token = tokens[idx]
-                if token.type == tokenize.NL or token.type == tokenize.NEWLINE:
-                    return idx - current_idx
-            return 0
-
-        # multiline comment skip
-        if token.string == '/' and (current_idx < max_idx - 1) and tokens[current_idx + 1].string == '*':
-            for idx in range(current_idx + 1, max_idx - 1):
-                token = tokens[idx]
-                if token.string == '*' and tokens[idx + 1].string == '/':
-                    return 2 + idx - current_idx
-            return 0
-    elif token.type in SKIP_TOKEN_TYPES:
-        return 1
-    return 0
-
-def is_trailing_comma(tokens, current_idx):
-    token = tokens[current_idx]
-    max_idx = len(tokens)
-    return (token.type == tokenize.OP and
-            token.string == ',' and
-            ( current_idx + 1 == max_idx or tokens[current_idx + 1].string == "}" or tokens[current_idx + 1].string == "]"))
-
-def remove_comments_and_newlines(tokens):
-    output = []
-    max_idx = len(tokens)
-    idx = 0
-    while idx < max_idx:
-        count = get_ignored_tokens_count(tokens, idx)
-        if (count):
-            idx += count
-        else:
-            output.append(tokens[idx])
-            idx += 1
-    return output
+# # # Blueprint cache # # #
+# Opt-in: set PROTECT_HYBRID_BLUEPRINT_CACHE to a directory (or to "1" for ~/.cache/protect-hybrid-js/blueprints)
+# to keep comment-free blueprints keyed by the SHA-256 of the raw file, so unchanged blueprints skip normalization.
+BLUEPRINT_LOADER_VERSION = "2"
+BLUEPRINT_CACHE_DEFAULT_SIZE_MB = 64
+
+def get_blueprint_cache_folder():
+    folder = os.environ.get('PROTECT_HYBRID_BLUEPRINT_CACHE')
+    if not folder:
+        return None
+    if folder == "1":
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        folder = os.path.join(cache_home, 'protect-hybrid-js', 'blueprints')
+    return folder
+
+def get_blueprint_cache_key(buffer):
+    return hashlib.sha256(buffer).hexdigest() + '-v' + BLUEPRINT_LOADER_VERSION + '.json'
+
+def read_blueprint_cache(folder, key):
+    cache_file = os.path.join(folder, key)
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as json_file:
+            json_str = json_file.read()
+        os.utime(cache_file)  # least recently used entries are evicted first
+        return json_str
+    except OSError:
+        return None
 
-def remove_trailing_commas(tokens):
-    output = []
-    for i in range(0, len(tokens)):
-        if (not is_trailing_comma(tokens, i)):
-            output.append(tokens[i])
-    return output
+def write_blueprint_cache(folder, key, json_str):
+    temporary_file = None
+    try:
+        os.makedirs(folder, exist_ok=True)
+        # write next to the final entry and rename, concurrent runs never see a partial file
+        fd, temporary_file = tempfile.mkstemp(prefix='.' + key, dir=folder)
+        with os.fdopen(fd, 'w', encoding='utf-8') as json_file:
+            json_file.write(json_str)
+        os.replace(temporary_file, os.path.join(folder, key))
+        temporary_file = None
+        evict_blueprint_cache(folder)
+    except OSError:
+        if temporary_file is not None and os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+def evict_blueprint_cache(folder):
+    try:
+        max_size = int(os.environ.get('PROTECT_HYBRID_BLUEPRINT_CACHE_SIZE_MB', BLUEPRINT_CACHE_DEFAULT_SIZE_MB)) * 1024 * 1024
+    except ValueError:
+        max_size = BLUEPRINT_CACHE_DEFAULT_SIZE_MB * 1024 * 1024
+    entries = []
+    total_size = 0
+    for name in os.listdir(folder):
+        if name.startswith('.'):  # write in progress
+            continue
+        path = os.path.join(folder, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total_size += stat.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size -= size
+
+# # # Json load with comments removal # # #
+# Single pass over the raw bytes: findall() returns only the kept group, so whitespace, comments and trailing commas
+# (followed only by whitespace/comments and '}', ']' or end of file) are dropped. Comments are recognized as the
+# previous tokenize based loader did: '//' and '/*' not followed by '*' or '=', closed by an odd run of '*' and a '/'
+# not followed by '/' or '=' ('**' and '//' were operators, spaces between '/' and '*' were ignored), skipping quoted
+# strings and '#' comments in between. Strings (but triple quoted ones) end on their line, a lone quote is kept as is.
+JSONC_STRING = rb'"[^"\\\r\n]*(?:\\.[^"\\\r\n]*)*"'
+JSONC_TRIPLE_QUOTED = rb'"""(?:[^"\\]|\\[\s\S]|"(?!""))*"""|' + rb"""'''(?:[^'\\]|\\[\s\S]|'(?!''))*'''"""
+JSONC_LONE_QUOTE = rb"""(?:"(?![^"\\\r\n]*(?:\\.[^"\\\r\n]*)*")|'(?![^'\\\r\n]*(?:\\.[^'\\\r\n]*)*'))"""
+JSONC_QUOTED = (JSONC_TRIPLE_QUOTED + rb'|' + JSONC_STRING +
+                rb"""|'[^'\\\r\n]*(?:\\.[^'\\\r\n]*)*'|#[^\r\n]*(?![^\r\n])|""" + JSONC_LONE_QUOTE)
+JSONC_TOKEN = JSONC_QUOTED + rb"""|[^"'#*]"""
+JSONC_NO_TOKEN = rb'(?:' + JSONC_LONE_QUOTE + rb'|[\\$?`]|!(?!=))'
+JSONC_LINE_COMMENT = rb'//(?!=)[^\r\n]*(?![^\r\n])'
+JSONC_BLOCK_COMMENT = (rb'/(?=[ \t\f]*\*(?![*=]))(?:' + JSONC_TOKEN +  # never past its end
+                       rb'|(?:\*\*)+(?!\*)|\*(?:\*\*)*(?![*=]|[ \t\f]*/(?![/=])))*'
+                       rb'(?:\*\*)*\*[ \t\f]*/(?![/=])')
+
+# Single quoted strings, '#' comments and triple quoted strings were kept with their spaces, as were the spaces before
+# a lone quote or a character starting no token. An indented first line made the tokenize based loader end with
+# a DEDENT token, so the last comma was kept.
+def get_jsonc_strip_pattern(tokenize_quirks, indented):
+    if tokenize_quirks:
+        kept = JSONC_QUOTED + rb"""|[^\s"'#/,]+|[ \t\f]+(?=""" + JSONC_NO_TOKEN + rb')'
+        dropped = rb'\s+(?!\s|' + JSONC_NO_TOKEN + rb')|\s*[\r\n\v]'
+    else:
+        kept = JSONC_STRING + rb'|[^\s"/,]+|"'
+        dropped = rb'\s+'
+    end_of_file = rb'' if indented else rb'|\Z'
+    comment = JSONC_LINE_COMMENT + rb'|' + JSONC_BLOCK_COMMENT
+    return re.compile(
+        dropped + rb'|' + comment +  # whitespace and comments
+        rb'|((?:' + kept +  # kept: strings and plain JSON...
+        rb'|,(?!\s*(?:(?:' + comment + rb')\s*)*(?:[}\]]' + end_of_file + rb')))+'  # ...non-trailing commas
+        rb'|/)'  # ...and slashes starting no comment
+        rb'|,')  # trailing comma
+
+JSONC_STRIP_PATTERNS = {(tokenize_quirks, indented): get_jsonc_strip_pattern(tokenize_quirks, indented)
+                        for tokenize_quirks in (False, True) for indented in (False, True)}
+JSONC_SINGLE_QUOTED = JSONC_STRING + rb"""|'[^'\\\r\n]*(?:\\.[^'\\\r\n]*)*'|#[^\r\n]*"""
+JSONC_QUOTED_PATTERN = re.compile(JSONC_TRIPLE_QUOTED + rb'|' + JSONC_SINGLE_QUOTED)
+JSONC_UNTERMINATED_PATTERN = re.compile(
+    JSONC_TRIPLE_QUOTED + rb'''|("""|\'\'\'|"[^"\\\r\n]*(?:\\[^\r\n][^"\\\r\n]*)*\\\r?\n'''
+    rb"""|'[^'\\\r\n]*(?:\\[^\r\n][^'\\\r\n]*)*\\\r?\n)|""" + JSONC_SINGLE_QUOTED)
+JSONC_NO_TOKEN_PATTERN = re.compile(rb"""["'\\$?`!]""")
+# The tokenize based loader read the whole file as a single line: a blank first line made all of it blank and a '#'
+# at its start made all of it a comment.
+JSONC_LEADING_PATTERN = re.compile(rb'(?:\xef\xbb\xbf)?([ \t\f]*)([\r\n#]?)')
+
+def get_bracket_depth(data):
+    return (data.count(b'{') + data.count(b'[') + data.count(b'(') -
+            data.count(b'}') - data.count(b']') - data.count(b')'))
+
+# The tokenize based loader failed before the JSON was parsed on a triple quoted string left open or a string
+# continued by a backslash ending its line and, outside strings (code), comments included, on brackets left open
+# (or closed once too often) and on a backslash ending a line.
+def get_tokenize_error(buffer, code):
+    if b'"""' in buffer or b"'''" in buffer or b'\\\n' in buffer or b'\\\r\n' in buffer:
+        for match in JSONC_UNTERMINATED_PATTERN.finditer(buffer):
+            if match.group(1) is not None:
+                column = len(buffer[:match.start(1)].decode('utf-8-sig', 'replace'))
+                return "('EOF in multi-line string', (1, " + str(column) + "))"
+    if get_bracket_depth(code) != 0 or b'\\\n' in code or b'\\\r\n' in code:
+        return "('EOF in multi-line statement', (2, 0))"
+    return None
 
 def get_json_as_string(file_name):
-    output_string = ""
     with open(file_name, 'rb') as json_file:
-        try:
-            tokens = list(tokenize.tokenize(json_file.read))
-        except Exception as e:
-            raise ValueError("Provided blueprint file '" + file_name + "' contains invalid JSON. " + str(e))
-        tokens = remove_comments_and_newlines(tokens)
-        tokens = remove_trailing_commas(tokens)
-        for i in range(0, len(tokens)):
-            output_string += tokens[i].string
-    return output_string.strip()
+        buffer = json_file.read()
+    cache_folder = get_blueprint_cache_folder()
+    if cache_folder is not None:
+        cache_key = get_blueprint_cache_key(buffer)
+        json_str = read_blueprint_cache(cache_folder, cache_key)
+        if json_str is not None:
+            return json_str
+    leading = JSONC_LEADING_PATTERN.match(buffer)
+    if leading.group(2) == b'#':
+        json_bytes = buffer[leading.start(2):]
+    elif leading.group(2):
+        json_bytes = b''
+    else:
+        code = JSONC_QUOTED_PATTERN.sub(b' ', buffer)
+        tokenize_error = get_tokenize_error(buffer, code)
+        if tokenize_error is not None:
+            raise ValueError("Provided blueprint file '" + file_name + "' contains invalid JSON. " + tokenize_error)
+        tokenize_quirks = (JSONC_NO_TOKEN_PATTERN.search(code) is not None or
+                           b"'" in buffer or b'#' in buffer or b'"""' in buffer)
+        indented = leading.group(1).endswith((b' ', b'\t')) and leading.end() < len(buffer)
+        json_bytes = b''.join(JSONC_STRIP_PATTERNS[tokenize_quirks, indented].findall(buffer))
+    try:
+        json_str = json_bytes.decode('utf-8-sig').strip()
+    except Exception as e:
+        raise ValueError("Provided blueprint file '" + file_name + "' contains invalid JSON. " + str(e))
+    if cache_folder is not None:
+        write_blueprint_cache(cache_folder, cache_key, json_str)
+    return json_str
+
+class InsensitiveDict(dict):
+    """Blueprint object with its keys also indexed by lower case, so case insensitive lookups do not scan all keys.
+    Keys keep their original spelling, which is what json.dump writes back."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # reversed, so the first spelling of a key wins as with a linear scan
+        self.lower_keys = {key.lower(): key for key in reversed(list(self.keys()))}
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.lower_keys.setdefault(key.lower(), key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.forget_key(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __or__(self, other):
+        merged = self.copy()
+        merged.update(other)
+        return merged
+
+    def __ror__(self, other):
+        merged = InsensitiveDict(other)
+        merged.update(self)
+        return merged
+
+    # dict implements these without __setitem__ and __delitem__, the index is kept up to date here
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = super().pop(key)
+        self.forget_key(key)
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.forget_key(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self.lower_keys.clear()
+
+    def copy(self):
+        return InsensitiveDict(self)
+
+    @classmethod
+    def fromkeys(cls, keys, value=None):
+        return cls((key, value) for key in keys)
+
+    # removed key: another spelling of it takes over the index entry
+    def forget_key(self, key):
+        lower_key = key.lower()
+        if self.lower_keys.get(lower_key) == key:
+            del self.lower_keys[lower_key]
+            for other_key in self.keys():
+                if other_key.lower() == lower_key:
+                    self.lower_keys[lower_key] = other_key
+                    break
+
+    def find_key(self, key):
+        return self.lower_keys.get(key.lower())
+
+def find_insensitive_key(json, key):
+    if isinstance(json, InsensitiveDict):
+        return json.find_key(key)
+    lower_key = key.lower()
+    for existing_key in json.keys():
+        if existing_key.lower() == lower_key:
+            return existing_key
+    return None
 
 def get_insensitive(json, key):
     if (json is None):
         return None
-    keys = list(json.keys())
-    for i in range(0, len(keys)):
-        if (keys[i].lower() == key.lower()):
-            return json[keys[i]]
-    return None
+    existing_key = find_insensitive_key(json, key)
+    if existing_key is None:
+        return None
+    return json[existing_key]
 
 def set_insensitive(json, key, value):
     if (json is None):
         return None
-    keys = list(json.keys())
-    for i in range(0, len(keys)):
-        if (keys[i].lower() == key.lower()):
-            json[keys[i]] = value;
-            return;
+    existing_key = find_insensitive_key(json, key)
+    if existing_key is not None:
+        json[existing_key] = value
 
 def load_json_from_file(file_name):
     json_str = get_json_as_string(file_name)
@@ -224,16 +425,267 @@ def load_json_from_file(file_name):
         raise ValueError("Provided blueprint file '" + file_name +
                          "' is empty. Make sure the file is a non-empty JSON.")
     try:
-        return json.loads(json_str)
+        return json.loads(json_str, object_pairs_hook=InsensitiveDict)
     except Exception as e:
         raise ValueError("Provided blueprint file '" + file_name + "' contains invalid JSON. " + str(e))
 
 
+# # # Blueprint overlays # # #
+# The base blueprint is deep-merged with ordered overlays (-b4ho), later overlays win. Objects are merged with case
+# insensitive keys keeping the base spelling, any other value (arrays included) is replaced and null removes the key.
+
+def merge_blueprint(base, overlay):
+    merged = base.copy()
+    for key, value in overlay.items():
+        existing_key = find_insensitive_key(merged, key)
+        if existing_key is None:
+            if value is not None:
+                merged[key] = value
+        elif value is None:
+            del merged[existing_key]
+        elif isinstance(merged[existing_key], dict) and isinstance(value, dict):
+            merged[existing_key] = merge_blueprint(merged[existing_key], value)
+        else:
+            merged[existing_key] = value
+    return merged
+
+def get_blueprint_overlay_key(file_names):
+    digest = hashlib.sha256()
+    for file_name in file_names:
+        with open(file_name, 'rb') as blueprint_file:
+            digest.update(hashlib.sha256(blueprint_file.read()).digest())
+    return digest.hexdigest() + '-v' + BLUEPRINT_LOADER_VERSION + '.merged.json'
+
+# overlay key -> merged blueprint, as written to the temporary file
+MERGED_BLUEPRINTS = {}
+
+def materialize_blueprint_overlays(base_file, overlay_files):
+    """Returns the path of the merged blueprint, a temporary file of this run to be removed by the caller."""
+    key = get_blueprint_overlay_key([base_file] + overlay_files)
+    # each unique combination of base and overlay contents is merged once per process, and once across runs with
+    # the blueprint cache. The cache entry itself is not passed to protect-hybrid-js, other runs may evict it
+    # before it is read.
+    json_str = MERGED_BLUEPRINTS.get(key)
+    if json_str is None:
+        cache_folder = get_blueprint_cache_folder()
+        json_str = None if cache_folder is None else read_blueprint_cache(cache_folder, key)
+        if json_str is None:
+            merged = load_json_from_file(base_file)
+            for overlay_file in overlay_files:
+                merged = merge_blueprint(merged, load_json_from_file(overlay_file))
+            json_str = json.dumps(merged, indent=2)
+            if cache_folder is not None:
+                write_blueprint_cache(cache_folder, key, json_str)
+        MERGED_BLUEPRINTS[key] = json_str
+
+    fd, merged_file = tempfile.mkstemp(prefix='protect-hybrid-', suffix='.merged.json')
+    with os.fdopen(fd, 'w', encoding='utf-8') as json_file:
+        json_file.write(json_str)
+    return merged_file
+
+
 # # # Utils # # #
 
 def remove_dir(dir_name):
     if os.path.isdir(dir_name):
         shutil.rmtree(dir_name)
+    release_temporary_folder(dir_name)
+
+
+RAM_WORKSPACE = "ram"
+RAM_WORKSPACE_FOLDERS = ["/dev/shm", "/run/shm", "/Volumes/RAMDisk"]
+
+
+def get_workspace_folder(workspace, required_size):
+    """Returns the folder for the temporary files of a run, None for the default temporary folder.
+    'ram' selects a RAM-backed folder. Workspaces with less free space than required_size fall back to the default."""
+    if workspace is None:
+        return None
+    if workspace.lower() == RAM_WORKSPACE:
+        ram_folders = [folder for folder in RAM_WORKSPACE_FOLDERS if os.path.isdir(folder)]
+        if len(ram_folders) == 0:
+            print('No RAM-backed folder found, using the default temporary folder.')
+            return None
+        workspace = ram_folders[0]
+    os.makedirs(workspace, exist_ok=True)
+    free_size = shutil.disk_usage(workspace).free
+    if free_size < required_size:
+        print('Workspace "{}" has {} MB free, {} MB needed: using the default temporary folder.'
+              .format(workspace, free_size // (1024 * 1024), required_size // (1024 * 1024)))
+        return None
+    print('Using the workspace "{}".'.format(workspace))
+    return workspace
+
+
+FICLONE = 0x40049409  # Linux ioctl, _IOW(0x94, 9, int)
+
+
+def clone_file(source, target):
+    """Copies source to target as shutil.copy2, as a copy-on-write clone (reflink) where the file system supports it."""
+    if sys.platform == 'darwin':
+        try:
+            # clonefile(2), APFS
+            if ctypes.CDLL(None, use_errno=True).clonefile(os.fsencode(source), os.fsencode(target), 0) == 0:
+                return target
+        except (AttributeError, OSError):
+            pass
+    elif fcntl is not None:
+        try:
+            with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+                fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            shutil.copystat(source, target)
+            return target
+        except OSError:
+            pass
+    return shutil.copy2(source, target)
+
+
+def clone_tree(source_folder, target_folder, hardlink_patterns=(), hardlink_skip_patterns=()):
+    """Copies source_folder to target_folder as shutil.copytree, cloning files where the file system supports it.
+    Files matching hardlink_patterns and none of hardlink_skip_patterns (relative paths) are hardlinked instead,
+    only for files neither tree modifies later."""
+    def clone(source, target):
+        relative_path = os.path.relpath(source, source_folder).replace(os.sep, '/')
+        if (any(fnmatch.fnmatch(relative_path, pattern) for pattern in hardlink_patterns) and
+                not any(fnmatch.fnmatch(relative_path, pattern) for pattern in hardlink_skip_patterns)):
+            try:
+                os.link(source, target)
+                return target
+            except OSError:
+                pass
+        return clone_file(source, target)
+    return shutil.copytree(source_folder, target_folder, copy_function=clone)
+
+
+TEMPORARY_FOLDER_PREFIX = "protect-hybrid-"
+TEMPORARY_FOLDER_LOCK_SUFFIX = ".lock"
+TEMPORARY_FOLDER_LOCKS = {}  # temporary folder -> its lock file, held while the run uses the folder
+TRASH_FOLDER_NAME = "protect-hybrid-trash"
+EMPTY_TRASH_SCRIPT = ("import os, shutil, sys\n"
+                      "for name in os.listdir(sys.argv[1]):\n"
+                      "    shutil.rmtree(os.path.join(sys.argv[1], name), ignore_errors=True)\n")
+
+
+# The lock file next to the folder is locked (flock, also across hosts sharing the folder over NFS) until the folder is
+# removed, so folders left by crashed runs are the ones whose lock can be taken. It is kept out of the folder, whose
+# content is protected and repacked. The lock file is locked before it gets its name.
+def make_temporary_folder(workspace=None):
+    folder = tempfile.mkdtemp(prefix="{}{}-".format(TEMPORARY_FOLDER_PREFIX, os.getpid()), dir=workspace)
+    if fcntl is not None:
+        lock_path = folder + TEMPORARY_FOLDER_LOCK_SUFFIX
+        lock_file = open(lock_path + ".new", 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(lock_path + ".new", lock_path)
+        TEMPORARY_FOLDER_LOCKS[folder] = lock_file
+    return folder
+
+
+def release_temporary_folder(folder):
+    lock_file = TEMPORARY_FOLDER_LOCKS.pop(folder, None)
+    if lock_file is not None:
+        remove_file_if_exists(folder + TEMPORARY_FOLDER_LOCK_SUFFIX)
+        lock_file.close()
+
+
+def remove_file_if_exists(file_name):
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+
+
+def move_to_trash(dir_name):
+    """Renames dir_name into the trash folder next to it, returns the trash folder or None if it could not be moved."""
+    trash_folder = os.path.join(os.path.dirname(os.path.abspath(dir_name)), TRASH_FOLDER_NAME)
+    try:
+        os.makedirs(trash_folder, exist_ok=True)
+        os.rename(dir_name, os.path.join(trash_folder, os.path.basename(dir_name)))
+    except OSError:
+        return None
+    return trash_folder
+
+
+def reap_temporary_folders(folder):
+    """Moves the temporary folders no run holds the lock of (crashed or killed runs) into the trash and removes their
+    lock files. Folders without a lock file are left alone."""
+    if fcntl is None:
+        return
+    for name in os.listdir(folder):
+        if not name.startswith(TEMPORARY_FOLDER_PREFIX) or not name.endswith(TEMPORARY_FOLDER_LOCK_SUFFIX):
+            continue
+        lock_path = os.path.join(folder, name)
+        try:
+            lock_fd = os.open(lock_path, os.O_RDWR)
+        except OSError:
+            continue
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            temporary_folder = lock_path[:-len(TEMPORARY_FOLDER_LOCK_SUFFIX)]
+            if os.path.isdir(temporary_folder):
+                move_to_trash(temporary_folder)
+            remove_file_if_exists(lock_path)
+        except OSError:
+            pass  # in use
+        finally:
+            os.close(lock_fd)
+
+
+def remove_dirs_in_background(dir_names):
+    """Moves the folders into the trash and empties it in a detached process, together with leftovers of crashed runs.
+    Folders which cannot be moved are removed right away."""
+    trash_folders = set()
+    for dir_name in dir_names:
+        if not os.path.isdir(dir_name):
+            release_temporary_folder(dir_name)
+            continue
+        trash_folder = move_to_trash(dir_name)
+        if trash_folder is None:
+            remove_dir(dir_name)
+        else:
+            release_temporary_folder(dir_name)
+            trash_folders.add(trash_folder)
+    for trash_folder in trash_folders:
+        reap_temporary_folders(os.path.dirname(trash_folder))
+        subprocess.Popen([sys.executable, '-c', EMPTY_TRASH_SCRIPT, trash_folder], stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def get_folder_size(folder):
+    size = 0
+    for folder_name, subfolders, file_names in os.walk(folder):
+        for file_name in file_names:
+            file_path = os.path.join(folder_name, file_name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def get_zip_file_size(file_name):
+    with zipfile.ZipFile(file_name) as zf:
+        return sum(info.file_size for info in zf.infolist())
+
+
+def resolve_ignore_paths(ignore_paths, input_folder):
+    """Ignore paths which exist as given are kept, the others are resolved relative to the input folder.
+    Input folder is resolved once and only paths starting with an entry of the working directory are checked on disk."""
+    input_realpath = os.path.realpath(input_folder)
+    try:
+        # lower case, a case insensitive file system still gets the final os.path.exists check
+        working_directory_entries = set(entry.lower() for entry in os.listdir(os.curdir))
+        working_directory_entries.update([os.curdir, os.pardir])
+    except OSError:
+        working_directory_entries = None
+    resolved_paths = {}
+    for path in ignore_paths:
+        if path in resolved_paths:
+            continue
+        if working_directory_entries is None or os.path.isabs(path):
+            exists = os.path.exists(path)
+        else:
+            first_component = re.split(r'[\\/]', path, 1)[0].lower()
+            exists = first_component in working_directory_entries and os.path.exists(path)
+        resolved_paths[path] = path if exists else os.path.join(input_realpath, path.strip("/"))
+    return resolved_paths
 
 
 def get_from_path(file_name):
@@ -436,7 +888,9 @@ def print_section_end():
 
 def protect_xcarchive(args, protect_hybrid_path, protect_hybrid_blueprint, protect_apple_blueprint, xcarchive_path, native_protection):
 
-    temporary_folder = tempfile.mkdtemp()
+    # the xcarchive is copied once, twice with protect-apple output
+    workspace = get_workspace_folder(args.workspace, get_folder_size(xcarchive_path) * (2 if native_protection else 1))
+    temporary_folder = make_temporary_folder(workspace)
     input_folder = os.path.join(temporary_folder, "input")
     os.mkdir(input_folder)
     output_folder = os.path.join(temporary_folder, "output")
@@ -468,6 +922,7 @@ def protect_xcarchive(args, protect_hybrid_path, protect_hybrid_blueprint, prote
             sjs.output_folder = output_folder
 
         sjs.config_file_path = protect_hybrid_blueprint
+        sjs.work_folder = temporary_folder
         if args.reactnative:
             sjs.target_type = TargetType.REACT_NATIVE
         if args.nativescript:
@@ -485,7 +940,7 @@ def protect_xcarchive(args, protect_hybrid_path, protect_hybrid_blueprint, prote
         base_name = os.path.basename(xcarchive_path)
         protected_protect_hybrid_xcarchive_path = os.path.join(temporary_folder, "Protected_" + base_name)
         remove_dir(protected_protect_hybrid_xcarchive_path)  # remove output from previous run
-        shutil.copytree(xcarchive_path, protected_protect_hybrid_xcarchive_path)
+        clone_tree(xcarchive_path, protected_protect_hybrid_xcarchive_path)
 
         files = get_files_in_folder(output_folder, ["*"], [], output_folder, True)
         for file in files:
@@ -540,7 +995,8 @@ def protect_xcarchive(args, protect_hybrid_path, protect_hybrid_blueprint, prote
         if found_xcarchive is not None:
             final_output = xcarchive_path.replace(os.path.basename(xcarchive_path), "Protected " + base_name)
             remove_dir(final_output)
-            shutil.copytree(found_xcarchive, final_output)
+            # the temporary archive is removed afterwards
+            clone_tree(found_xcarchive, final_output, ["*"])
             print("Protected archive:" + final_output)
 
         print_section_end()
@@ -554,13 +1010,19 @@ def protect_xcarchive(args, protect_hybrid_path, protect_hybrid_blueprint, prote
         print_section_start('Cleaning')
         if sjs.updated_config_file_path is not None and os.path.exists(sjs.updated_config_file_path):
             os.remove(sjs.updated_config_file_path)
-        print('Removed the temporary directory "{}".'.format(temporary_folder))
-        remove_dir(temporary_folder)
+        if args.async_cleanup:
+            remove_dirs_in_background([temporary_folder])
+            print('Removing the temporary directory "{}" in the background.'.format(temporary_folder))
+        else:
+            print('Removed the temporary directory "{}".'.format(temporary_folder))
+            remove_dir(temporary_folder)
         print_section_end()
 
 
 def protect_ipa(args, protect_hybrid_path, protect_hybrid_blueprint, ipa_path):
-    temporary_folder = tempfile.mkdtemp()
+    # the ipa is extracted and copied for protect-hybrid-js output
+    workspace = get_workspace_folder(args.workspace, get_zip_file_size(ipa_path) * 2)
+    temporary_folder = make_temporary_folder(workspace)
     input_folder = os.path.join(temporary_folder, "input")
     os.mkdir(input_folder)
     output_folder = os.path.join(temporary_folder, "output")
@@ -590,6 +1052,7 @@ def protect_ipa(args, protect_hybrid_path, protect_hybrid_blueprint, ipa_path):
         print_section_start('Protecting with protect-hybrid-js')
 
         sjs.config_file_path = protect_hybrid_blueprint
+        sjs.work_folder = temporary_folder
 
         if args.reactnative:
             sjs.target_type = TargetType.REACT_NATIVE
@@ -624,8 +1087,12 @@ def protect_ipa(args, protect_hybrid_path, protect_hybrid_blueprint, ipa_path):
         print_section_start('Cleaning')
         if sjs.updated_config_file_path is not None and os.path.exists(sjs.updated_config_file_path):
             os.remove(sjs.updated_config_file_path)
-        print('Removed the temporary directory "{}".'.format(temporary_folder))
-        remove_dir(temporary_folder)
+        if args.async_cleanup:
+            remove_dirs_in_background([temporary_folder])
+            print('Removing the temporary directory "{}" in the background.'.format(temporary_folder))
+        else:
+            print('Removed the temporary directory "{}".'.format(temporary_folder))
+            remove_dir(temporary_folder)
         print_section_end()
 
 # # # MAIN # # #
@@ -642,6 +1109,8 @@ def execute():
     protect_apple_config = get_input(args.blueprint_for_apple)
 
     native_protection = not args.disable_native_protection
+    protect_hybrid_overlays = args.blueprint_overlay_for_hybrid or []
+    temporary_protect_hybrid_config = None
 
     # initial validation
 
@@ -666,18 +1135,31 @@ def execute():
             validate_file_exists(protect_apple_config)
         if protect_hybrid_config is not None:
             validate_file_exists(protect_hybrid_config)
+        if len(protect_hybrid_overlays) > 0:
+            if protect_hybrid_config is None:
+                raise ValueError("Blueprint overlays require the blueprint file for protect-hybrid-js (-b4h).")
+            for overlay in protect_hybrid_overlays:
+                validate_file_exists(overlay)
+            temporary_protect_hybrid_config = materialize_blueprint_overlays(protect_hybrid_config, protect_hybrid_overlays)
+            protect_hybrid_config = temporary_protect_hybrid_config
         protect_hybrid_path = validate_executable_path(protect_hybrid_path, "protect-hybrid-js", "Digital.ai Hybrid JavaScript Protection")
 
     except Exception as e:
+        if temporary_protect_hybrid_config is not None:
+            os.remove(temporary_protect_hybrid_config)
         raise SystemExit(e)
 
-    if native_protection:
-        protect_xcarchive(args, protect_hybrid_path, protect_hybrid_config, protect_apple_config, args.xcarchive, native_protection)
-    else:
-        if args.ipa is not None:
-            protect_ipa(args, protect_hybrid_path, protect_hybrid_config, args.ipa)
+    try:
+        if native_protection:
+            protect_xcarchive(args, protect_hybrid_path, protect_hybrid_config, protect_apple_config, args.xcarchive, native_protection)
         else:
-            protect_xcarchive(args, protect_hybrid_path, protect_hybrid_config, None, args.xcarchive, native_protection)
+            if args.ipa is not None:
+                protect_ipa(args, protect_hybrid_path, protect_hybrid_config, args.ipa)
+            else:
+                protect_xcarchive(args, protect_hybrid_path, protect_hybrid_config, None, args.xcarchive, native_protection)
+    finally:
+        if temporary_protect_hybrid_config is not None:
+            os.remove(temporary_protect_hybrid_config)
 
     print('Digital.ai Hybrid JavaScript Protection (iOS) - finish')
 